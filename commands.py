@@ -21,14 +21,15 @@ from itertools import takewhile
 import sys
 import logging
 import datetime
+import time
 import struct
 import subprocess
 
-from mongokit.schema_document import ValidationError
 from pyxmpp2.exceptions import JIDError
 
 import models
-from models import logmsg
+import metrics
+from models import logmsg, ValidationError
 from misc import *
 import config
 
@@ -39,6 +40,10 @@ command handling, should be called from messages.py
 # key is the command name, value is a (func, doc, flags) tuple
 __commands = {}
 logger = logging.getLogger(__name__)
+command_latency = metrics.histogram(
+  'command_latency', 'time spent handling a command')
+# time spent in each command
+command_stats = CallStats(command_latency)
 __brief_help = ('nick', 'dm', 'old', 'online', 'stop', 'quit')
 
 def command(name, doc, flags=PERM_USER):
@@ -86,7 +91,11 @@ def handle_command(self, msg):
 
   rest = len(cmds) == 2 and cmds[1] or ''
   if cmd in __commands:
-    if __commands[cmd][0](self, rest) is not False:
+    t = time.time()
+    ret = __commands[cmd][0](self, rest)
+    t = time.time() - t
+    command_stats.record(cmd, t)
+    if ret is not False:
       # we handled it
       return True
   self.reply(_('No such command found.'))
@@ -113,6 +122,7 @@ if getattr(config, 'blockable', False):
     if u:
       self.current_user['badpeople'].append(u.jid)
       self.current_user.save()
+      self.receiver_index.block(self.current_user.jid, u.jid)
       self.reply(_('You are now blocking %s') % u['nick'])
     else:
       self.reply(_('Nobody with the nick "%s" found.') % nick)
@@ -235,6 +245,19 @@ def do_longhelp(self, arg):
     text.append('%s%s:\t%s' % (prefix, name, doc))
   self.reply('\n'.join(text))
 
+@command('metrics', _('show traffic and latency statistics; use "reset" to start over'), PERM_SYSADMIN)
+def do_metrics(self, arg):
+  if arg.strip() == 'reset':
+    metrics.reset()
+    self.reply(_('ok.'))
+    return
+  self.send_chunked(self.current_jid, metrics.report())
+
+@command('more', _('show more messages sent while you lost the connection'))
+def do_more(self, arg):
+  if not self.send_lost_more():
+    self.reply(_('No more messages.'))
+
 def get_nick_help():
   nick_help = _('change your nick; show your current nick if no new nick provided')
   if getattr(config, 'nick_change_interval', None):
@@ -263,9 +286,10 @@ def do_nick(self, new):
   if old_nick is not None:
     msg = _('%s is now known as %s.') % (old_nick, new_nick)
     logmsg(self.current_jid, msg)
-    for u in self.get_message_receivers():
-      if u != bare:
-        self.send_message(u, msg)
+    # after what's been said before
+    self.flush_burst()
+    self.send_message_many(
+      (u for u in self.get_message_receivers() if u != bare), msg)
 
 @command('old', _('show at most 50 history entries in an hour; if argument given, it specifies either the number of entries, or the time period passed from now (format is same as `stop\' command)'))
 def do_old(self, arg):
@@ -290,14 +314,17 @@ def do_old(self, arg):
   except (struct.error, OverflowError):
     self.reply(_('Overflow!'))
     return
-  if q:
-    if self.now - q[0].time > ONE_DAY:
-      format = dateformat
-    else:
-      format = timeformat
-  else:
+  if not q:
     self.reply(_('No history entries match your criteria'))
     return
+  self.send_chunked(self.current_jid, format_log(self, q))
+
+def format_log(self, q):
+  '''format log entries `q`, which are in chronological order'''
+  if self.now - q[0].time > ONE_DAY:
+    format = dateformat
+  else:
+    format = timeformat
 
   text = []
   for l in q:
@@ -310,34 +337,57 @@ def do_old(self, arg):
       logger.warning('malformed log messages: %r', l)
       continue
     text.append(m)
-  self.reply('\n'.join(text))
+  return text
 
 @command('online', _('show online user list; if argument given, only nicks with the argument inbetween will be shown'))
 def do_online(self, arg):
   header = _('online users list')
   if arg:
     header += _(' (with "%s" inbetween)') % arg
-  text = []
+
+  cache = self.online_cache
+  if cache is None or (cache[1] is not None and self.now >= cache[1]):
+    cache = self.online_cache = render_online(self)
+  lines, __ = cache
+
+  if arg:
+    text = [line for nick, line in lines if nick.find(arg) != -1]
+  else:
+    text = [line for nick, line in lines]
+  n = len(text)
+  text.insert(0, header)
+  text.append(N_('%d user listed', '%d users listed', n) % n)
+  self.reply('\n'.join(text))
+
+def render_online(self):
+  '''render the `online` command for all online users
+
+  return a sorted list of (nick, line) and the time when this becomes
+  outdated, i.e. when some mute or stop ends.'''
+  lines = []
+  expires = None
+  missing_nicks = []
 
   now = self.now
-  for u in self.get_online_users():
-    user = models.connection.User.one({'jid': str(u)})
-    if user is None:
-      continue
-    if user.nick is None:
-      user.nick = hashjid(user.jid)
-      user.save()
+  online = [str(u) for u in self.get_online_users()]
+  with models.db_latency.time():
+    q = list(models.connection.User.find(
+      {'jid': {'$in': online}}, ['jid', 'nick', 'mute_until', 'stop_until']))
+  for user in q:
     nick = user.nick
-    if arg and nick.find(arg) == -1:
-      continue
+    if nick is None:
+      nick = hashjid(user.jid)
+      missing_nicks.append((user.jid, nick))
 
     line = '* ' + nick
     if user.mute_until > now:
       line += _(' <muted>')
+      expires = min(expires or user.mute_until, user.mute_until)
     if user.stop_until > now:
       line += _(' <stopped>')
+      expires = min(expires or user.stop_until, user.stop_until)
 
-    st = self.get_xmpp_status(u)
+    st = self.get_xmpp_status(user.jid)
     if st['show']:
       try:
         line += ' (%s)' % xmpp_show_map[st['show']]
@@ -346,18 +396,38 @@ def do_online(self, arg):
         logger.warning('unknown XMPP show: %s', st['show'])
     if st['status']:
       line += ' [%s]' % st['status'].strip()
-    text.append(line)
+    lines.append((nick, line))
 
-  text.sort()
-  n = len(text)
-  text.insert(0, header)
-  text.append(N_('%d user listed', '%d users listed', n) % n)
-  self.reply('\n'.join(text))
+  for jid, nick in missing_nicks:
+    with models.db_latency.time():
+      models.connection.User.collection.update(
+        {'jid': jid}, {'$set': {'nick': nick}})
+    self.leaderboard.set_nick(jid, nick)
+    self.nick_directory.set(jid, nick)
+    self.identity_map.invalidate(jid)
+
+  lines.sort(key=lambda x: x[1])
+  return lines, expires
 
 @command('pm', _('deprecated, use the "dm" command instead.'))
 def do_pm(self, arg):
   self.reply(_('This command is deprecated. Please use the "dm" command instead.'))
 
+@command('profile', _('show time spent in each message handler and command; use "reset" to start over'), PERM_SYSADMIN)
+def do_profile(self, arg):
+  from messages import handler_stats
+  if arg.strip() == 'reset':
+    handler_stats.reset()
+    command_stats.reset()
+    self.reply(_('ok.'))
+    return
+
+  text = [_('***message handlers***')]
+  text.extend(handler_stats.report())
+  text.append(_('***commands***'))
+  text.extend(command_stats.report())
+  self.send_chunked(self.current_jid, text)
+
 @command('quit', _('quit the group; only Gtalk users need this, other client users may just remove the buddy.'))
 def do_quit(self, arg):
   self.reply(_('See you!'))
@@ -379,6 +449,21 @@ def do_say(self, arg):
     self.user_reset_stop() # self.current_user is reloaded here
   self.dispatch_message(msg)
 
+search_max_results = getattr(config, 'search_max_results', 20)
+
+@command('search', _('search history for messages containing all the given words; show at most %d of the most recent ones') % search_max_results)
+def do_search(self, arg):
+  arg = arg.strip()
+  if not arg:
+    self.reply(_('What to search for?'))
+    return
+  q = models.search_index.search(arg, search_max_results)
+  if not q:
+    self.reply(_('No history entries match your criteria'))
+    return
+  q.reverse()
+  self.send_chunked(self.current_jid, format_log(self, q))
+
 @command('setstatus', _("get or set the talkbot's status message; use 'None' to clear"), PERM_GPADMIN)
 def do_setstatus(self, arg):
   st = self.group_status
@@ -441,12 +526,14 @@ def do_stop(self, arg):
     self.reply(_("Oops, it's too long."))
     return
   # PyMongo again...
-  models.connection.User.collection.update(
-    {'jid': self.current_user.jid}, {'$set': {
-      'stop_until': dt,
-    }}
-  )
-  self.current_user.reload()
+  with models.db_latency.time():
+    models.connection.User.collection.update(
+      {'jid': self.current_user.jid}, {'$set': {
+        'stop_until': dt,
+      }}
+    )
+  self.receiver_index.set_stop(self.current_user.jid, dt)
+  self.identity_map.invalidate(self.current_user.jid)
   t = (dt + config.timezoneoffset).strftime(longdateformat)
   self.reply(_('Ok, stop receiving messages until %s. You can change this by another `stop` command.') % t)
   self.user_update_presence(self.current_user)
@@ -491,14 +578,7 @@ def do_mute(self, arg):
   except OverflowError:
     self.reply(_("Oops, it's too long."))
     return
-  user.mute_until = dt
-  # user.save() would complain about float instead of int
-  models.connection.User.collection.update(
-    {'jid': user.jid}, {'$set': {
-      'mute_until': dt,
-    }}
-  )
-  user.reload()
+  self.user_set_mute(user, dt)
   t = (dt + config.timezoneoffset).strftime(dateformat)
   self.send_message(user.jid, _('You are disallowed to speak until %s') % t)
   args = dict(nick=nick, time=t)
@@ -507,29 +587,60 @@ def do_mute(self, arg):
     but={self.current_user.jid, user.jid},
   )
   self.reply(_('Ok, mute "%(nick)s" until %(time)s.') % args)
-  self.user_update_presence(user)
 
-@command('users', _('show all members; if argument given, only nicks with the argument inbetween will be shown'))
-def do_users(self, arg):
-  header = _('all users list')
-  if arg:
-    header += _(' (with "%s" inbetween)') % arg
-  text = []
+users_page_size = getattr(config, 'users_page_size', 50)
+users_max_listed = getattr(config, 'users_max_listed', 200)
 
-  q = models.connection.User.find(
-    None, ['nick', 'msg_chars', 'msg_count'],
-    sort=[('msg_count', 1), ('msg_chars', 1), ('nick', 1)])
-  for u in q:
-    if u.nick is None:
-      u.nick = hashjid(u.jid)
-      u.save()
-    if arg and u.nick.find(arg) == -1:
-      continue
-    text.append('* %(nick)s (N=%(msg_count)d, C=%(msg_chars)d)' % u)
+@command('users', _('show members, the most active first, %d per page; the argument can be "--page N" to show the Nth page, "--top N" to show the N most active members, or anything else so that only nicks with it inbetween will be shown') % users_page_size)
+def do_users(self, arg):
+  arg = arg.strip()
+  nick_filter = None
+  page = 1
+  size = users_page_size
+  paged = True
+  if arg.startswith('--page'):
+    try:
+      page = int(arg[len('--page'):])
+    except ValueError:
+      self.reply(_('arguments error: "--page" needs a number'))
+      return
+  elif arg.startswith('--top'):
+    try:
+      size = int(arg[len('--top'):])
+    except ValueError:
+      self.reply(_('arguments error: "--top" needs a number'))
+      return
+    if size <= 0 or size > users_max_listed:
+      self.reply(_('arguments error: at most %d users can be listed at a time') % users_max_listed)
+      return
+    paged = False
+  elif arg:
+    nick_filter = arg
+
+  if not self.leaderboard.loaded:
+    self.user_load_index()
+  total = self.leaderboard.count(nick_filter)
+  pages = max((total + size - 1) // size, 1)
+  if not 1 <= page <= pages:
+    self.reply(_('arguments error: page number should be between 1 and %d') % pages)
+    return
 
-  n = len(text)
-  text.insert(0, header)
+  header = _('all users list')
+  if nick_filter:
+    header += _(' (with "%s" inbetween)') % nick_filter
+  text = [header]
+  start = (page - 1) * size
+  for rank, jid, nick, count, chars in \
+      self.leaderboard.entries(start, start + size, nick_filter):
+    text.append('%d. %s (N=%d, C=%d)' % (
+      rank, nick or hashjid(jid), count, chars))
+
+  n = len(text) - 1
   text.append(N_('%d user listed', '%d users listed', n) % n)
+  if paged:
+    text.append(_('page %d of %d, %d users in total') % (page, pages, total))
+  else:
+    text.append(_('%d users in total') % total)
   self.reply('\n'.join(text))
 
 @command('uptime', _('invode `uptime` and show its output'))
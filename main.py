@@ -24,18 +24,21 @@ import os
 import logging
 import datetime
 import base64
+import select
 import hashlib
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from functools import partial
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import quoteattr
 
 import pyxmpp2.exceptions
+from pyxmpp2.exceptions import PyXMPPIOError
 from pyxmpp2.jid import JID
 from pyxmpp2.message import Message
 from pyxmpp2.presence import Presence
 from pyxmpp2.client import Client
 from pyxmpp2.settings import XMPPSettings
-from pyxmpp2.roster import RosterReceivedEvent
+from pyxmpp2.roster import RosterReceivedEvent, RosterUpdatedEvent
 from pyxmpp2.interfaces import EventHandler, event_handler, QUIT, NO_CHANGE
 from pyxmpp2.streamevents import DisconnectedEvent
 from pyxmpp2.interfaces import XMPPFeatureHandler
@@ -52,18 +55,65 @@ except ImportError:
 from misc import *
 import config
 import models
+import metrics
 from models import ValidationError
 from messages import MessageMixin
 from user import UserMixin
+from members import ReceiverIndex, Leaderboard, NickDirectory, IdentityMap
+from scheduler import ExpiryScheduler
+from outbox import Outbox, Outgoing
 
 if getattr(config, 'conn_lost_interval_minutes', False):
   conn_lost_interval = datetime.timedelta(minutes=config.conn_lost_interval_minutes)
 else:
   conn_lost_interval = None
+log_flush_interval = getattr(config, 'log_flush_interval', 5)
+reply_chunk_size = getattr(config, 'reply_chunk_size', 3000)
+reply_chunk_interval = getattr(config, 'reply_chunk_interval', 0.1)
+outbox_max_depth = getattr(config, 'outbox_max_depth', 50)
+outbox_interval = getattr(config, 'outbox_interval', 0.05)
+# see if the stream is still writable after writing this many bytes
+outbox_write_batch = 16384
+
+messages_in = metrics.counter('messages_in', 'chat messages received')
+stanzas_out = metrics.counter('stanzas_out', 'stanzas sent')
+fanout_size = metrics.histogram(
+  'fanout_size', 'receivers of a message sent to many', metrics.SIZE_BUCKETS)
+presence_in = metrics.counter('presence_in', 'available presences received')
+unavailable_in = metrics.counter('unavailable_in', 'unavailable presences received')
+online_count = metrics.gauge('online_users', 'online members')
+
+# the `to` of the template stanza used by `ChatBot.send_message_many`
+fanout_placeholder = JID('fanout.invalid')
+
+RawTransport = namedtuple('RawTransport', 'socket serializer write')
+
+def raw_transport(stream):
+  '''return the socket, serializer and write function of the transport of
+  `stream`, or `None` if it's closed
+
+  These are private to pyxmpp2's `TCPTransport`, and are only accessed here.
+  We need them to serialize a message once for many receivers, and to write
+  only as much as the socket takes without blocking. If the transport doesn't
+  have them, they are `None`, and messages are sent with `stream.send`.'''
+  if stream is None:
+    return
+  transport = stream.transport
+  try:
+    if transport._eof or transport._socket is None or not transport._serializer:
+      return
+    return RawTransport(transport._socket, transport._serializer, transport._write)
+  except AttributeError:
+    if not transport.is_connected():
+      return
+    return RawTransport(None, None, None)
 
 class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
   got_roster = False
   message_queue = None
+  # kept across reconnections like `message_queue`
+  outbox = None
+  _outbox_scheduled = False
   receipt_sender = None
   ignore = set()
 
@@ -83,10 +133,29 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
     self.client = Client(jid, handlers, settings)
 
     self.presence = defaultdict(dict)
+    # bare `JID`s with subscription 'both'
+    self.subscribers = set()
+    self.online_users = set()
+    # rendered `online` command; see `commands.render_online`
+    self.online_cache = None
+    self.receiver_index = ReceiverIndex()
+    self.leaderboard = Leaderboard()
+    self.nick_directory = NickDirectory()
+    self.identity_map = IdentityMap(
+      getattr(config, 'user_cache_size', 256),
+      getattr(config, 'user_cache_ttl', 300),
+    )
+    # mutes and stops to end, to update presences for
+    self.presence_expiry = ExpiryScheduler(
+      self.delayed_call, self.user_presence_expired)
     self.subscribes = ExpiringDictionary(default_timeout=5)
+    # where to continue `send_lost_message`
+    self.lost_message_cursors = ExpiringDictionary(default_timeout=3600)
     self.invited = {}
     self.avatar_hash = None
     self.settings = botsettings
+    if self.outbox is None:
+      self.outbox = Outbox(outbox_max_depth)
 
   def run(self):
     self.client.connect()
@@ -118,23 +187,41 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
       self.now = datetime.datetime.utcnow()
       for sender, stanza in q:
         self.current_jid = sender
-        self._cached_jid = None
-        try:
-          timestamp = stanza.as_xml().find('{urn:xmpp:delay}delay').attrib['stamp']
-        except AttributeError:
-          timestamp = None
-        self.handle_message(stanza.body, timestamp)
+        self.handle_message(stanza.body, delay_stamp(stanza))
       self.message_queue = self.__class__.message_queue = None
 
   @event_handler(RosterReceivedEvent)
   def roster_received(self, stanze):
+    self.user_load_index()
+    self.subscribers = {x.jid for x in self.roster if x.subscription == 'both'}
+    self.online_users = {
+      x for x in self.subscribers
+      if str(x) in self.presence and '@' in str(x)
+    }
+    online_count.set(len(self.online_users))
     self.delayed_call(2, self.handle_early_message)
     self.delayed_call(getattr(config, 'reconnect_timeout', 24 * 3600), self.signal_connect)
+    self.delayed_call(log_flush_interval, self.flush_log)
+    # what's left from the last connection
+    self.flush_outbox()
     nick, avatar_type, avatar_file = (getattr(config, x, None) for x in ('nick', 'avatar_type', 'avatar_file'))
     if nick or (avatar_type and avatar_file):
       self.set_vcard(nick, (avatar_type, avatar_file))
     return True
 
+  def flush_log(self):
+    models.log_buffer.flush()
+    self.delayed_call(log_flush_interval, self.flush_log)
+
+  @event_handler(RosterUpdatedEvent)
+  def roster_updated(self, event):
+    item = event.item
+    if item.subscription == 'both':
+      self.subscribers.add(item.jid)
+    else:
+      self.subscribers.discard(item.jid)
+    self.update_online_user(item.jid)
+
   def signal_connect(self):
     logging.info('Schedule to re-connecting...')
     self.client.disconnect()
@@ -147,6 +234,7 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
       logging.info("%s message: %s", stanza.from_jid, stanza.serialize())
       return True
 
+    messages_in.inc()
     sender = stanza.from_jid
     body = stanza.body
     self.current_jid = sender
@@ -174,27 +262,175 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
         self.message_queue = []
       self.message_queue.append((sender, stanza))
     else:
-      self.handle_message(body)
+      # messages kept by the server while we were offline aren't flooding
+      self.handle_message(body, late=delay_stamp(stanza) is not None)
 
     logging.info('done with new message')
     return True
 
   def send_message(self, receiver, msg):
-    if isinstance(receiver, str):
-      receiver = JID(receiver)
-
-    m = Message(
-      stanza_type = 'chat',
-      from_jid = self.jid,
-      to_jid = receiver,
-      body = msg,
-    )
-    self.send(m)
+    self._queue_message([str(receiver)], Outgoing(msg))
+
+  def send_message_many(self, receivers, msg):
+    '''send the same message to many receivers
+
+    The stanza is built and serialized only once; the copies written to the
+    stream differ only in the `to` attribute.'''
+    receivers = [str(u) for u in receivers]
+    fanout_size.observe(len(receivers))
+    self._queue_message(receivers, Outgoing(msg))
+
+  def _queue_message(self, receivers, entry):
+    '''write `entry` to `receivers` now if the stream takes it, or queue it
+    in `self.outbox`'''
+    outbox = self.outbox
+    n = 0
+    if not outbox:
+      # nobody is waiting
+      n = self._write_many(receivers, entry)
+    if n < len(receivers):
+      for u in receivers[n:]:
+        outbox.put(u, entry)
+      self._schedule_outbox()
+
+  def _stanza_parts(self, stream, raw, entry):
+    if entry.stream is not stream:
+      m = Message(
+        stanza_type = 'chat',
+        from_jid = self.jid,
+        to_jid = fanout_placeholder,
+        body = entry.body,
+      )
+      stream.fix_out_stanza(m)
+      data = raw.serializer.emit_stanza(m.as_xml())
+      # the addressing is in the start tag, before any user-provided text
+      pos = data.index('>')
+      entry.parts = data[:pos], data[pos:]
+      entry.stream = stream
+    return entry.parts
+
+  def _write_message(self, stream, raw, receiver, entry):
+    '''write `entry` to `receiver` (a `str`); return the bytes written
+
+    Raises `PyXMPPIOError` if the connection is broken.'''
+    if raw.write is None:
+      m = Message(
+        stanza_type = 'chat',
+        from_jid = self.jid,
+        to_jid = JID(receiver),
+        body = entry.body,
+      )
+      self.send(m)
+      return len(entry.body)
+    start_tag, rest = self._stanza_parts(stream, raw, entry)
+    tag = start_tag.replace(quoteattr(str(fanout_placeholder)), quoteattr(receiver), 1)
+    data = (tag + rest).encode('utf-8')
+    raw.write(data)
+    stanzas_out.inc()
+    return len(data)
+
+  def _write_many(self, receivers, entry):
+    '''write `entry` to `receivers` as long as the stream is writable; return
+    how many are written'''
+    stream = self.client.stream
+    raw = raw_transport(stream)
+    if raw is None:
+      return 0
+    n = 0
+    # check right away
+    written = outbox_write_batch
+    with stream.lock, stream.transport.lock:
+      try:
+        for u in receivers:
+          if written >= outbox_write_batch:
+            if not self.stream_writable():
+              break
+            written = 0
+          written += self._write_message(stream, raw, u, entry)
+          n += 1
+      except PyXMPPIOError as e:
+        logging.warning('error writing to the stream: %s', e)
+    return n
+
+  def _schedule_outbox(self):
+    if not self._outbox_scheduled:
+      self._outbox_scheduled = True
+      self.delayed_call(outbox_interval, self.flush_outbox)
+
+  def flush_outbox(self):
+    '''write messages in `self.outbox`, one for each receiver in turn, as
+    long as the stream is writable
+
+    If the stream is closed, they are kept for the next connection.'''
+    self._outbox_scheduled = False
+    outbox = self.outbox
+    stream = self.client.stream
+    raw = raw_transport(stream)
+    if not outbox or raw is None:
+      return
+    with stream.lock, stream.transport.lock:
+      try:
+        while outbox and self.stream_writable():
+          written = 0
+          while outbox and written < outbox_write_batch:
+            receiver, entry, dropped = outbox.pop()
+            if dropped:
+              note = Outgoing(N_(
+                '(%d message could not be delivered to you in time and was dropped; use the "old" command to see it)',
+                '(%d messages could not be delivered to you in time and were dropped; use the "old" command to see them)',
+                dropped) % dropped)
+              written += self._write_message(stream, raw, receiver, note)
+              dropped = 0
+            written += self._write_message(stream, raw, receiver, entry)
+      except PyXMPPIOError as e:
+        logging.warning('error writing to the stream: %s', e)
+        # keep them for the next connection; see `roster_received`
+        outbox.push_back(receiver, entry, dropped)
+        return
+    if outbox:
+      self._schedule_outbox()
 
   def reply(self, msg):
     self.send_message(self.current_jid, msg)
 
+  def send_chunked(self, receiver, lines):
+    '''send lines of a long text as messages of at most `reply_chunk_size`
+    characters
+
+    The first chunk is sent now; each of the rest is sent from the main
+    loop after the previous one has been written out and the stream is
+    writable again, so that a long reply neither starves others nor
+    overflows the connection.'''
+    chunks = iter(split_chunks(lines, reply_chunk_size))
+    self._send_chunks(receiver, chunks)
+
+  def _send_chunks(self, receiver, chunks):
+    writable = self.stream_writable()
+    if writable is None:
+      logging.warning('stream closed, rest of the reply to %s dropped', receiver)
+      return
+    elif writable and not self.outbox.depth(str(receiver)):
+      # the previous chunk has been written out
+      try:
+        chunk = next(chunks)
+      except StopIteration:
+        return
+      self.send_message(receiver, chunk)
+    self.delayed_call(reply_chunk_interval, self._send_chunks, receiver, chunks)
+
+  def stream_writable(self):
+    '''whether data can be written to the stream without blocking; `None` if
+    the stream is closed'''
+    raw = raw_transport(self.client.stream)
+    if raw is None:
+      return
+    if raw.socket is None:
+      # can't tell; `stream.send` will wait
+      return True
+    return bool(select.select((), (raw.socket,), (), 0)[1])
+
   def send(self, stanza):
+    stanzas_out.inc()
     self.client.stream.send(stanza)
 
   def delayed_call(self, seconds, func, *args, **kwargs):
@@ -209,10 +445,20 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
     return self.client.roster
 
   def get_online_users(self):
-    ret = [x.jid for x in self.roster if x.subscription == 'both' and \
-           str(x.jid) in self.presence and '@' in str(x.jid.bare())]
-    logging.info('%d online buddies: %r', len(ret), ret)
-    return ret
+    '''return the set of bare `JID`s of online members; don't modify it'''
+    return self.online_users
+
+  def update_online_user(self, jid):
+    '''update `self.online_users` for `jid` when its presence or roster item
+    changes'''
+    self.online_cache = None
+    jid = jid.bare()
+    plainjid = str(jid)
+    if jid in self.subscribers and plainjid in self.presence and '@' in plainjid:
+      self.online_users.add(jid)
+    else:
+      self.online_users.discard(jid)
+    online_count.set(len(self.online_users))
 
   def get_xmpp_status(self, jid):
     return sorted(self.presence[str(jid)].values(), key=lambda x: x['priority'], reverse=True)[0]
@@ -315,6 +561,7 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
   def handle_presence_available(self, stanza):
     if stanza.stanza_type not in ('available', None):
       return False
+    presence_in.inc()
 
     jid = stanza.from_jid
     plainjid = str(jid.bare())
@@ -347,6 +594,7 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
       'status': stanza.status,
       'priority': stanza.priority,
     }
+    self.update_online_user(jid)
 
     if self.get_user_by_jid(plainjid) is None:
       try:
@@ -366,6 +614,7 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
 
   @presence_stanza_handler('unavailable')
   def handle_presence_unavailable(self, stanza):
+    unavailable_in.inc()
     jid = stanza.from_jid
     plainjid = str(jid.bare())
     if plainjid in self.presence and plainjid != str(self.jid):
@@ -377,6 +626,7 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
         logging.info('%s[unavailable] (partly)', jid)
       else:
         del self.presence[plainjid]
+        self.update_online_user(jid)
         self.now = datetime.datetime.utcnow()
         self.user_disappeared(plainjid)
         logging.info('%s[unavailable] (totally)', jid)
@@ -454,16 +704,28 @@ class ChatBot(MessageMixin, UserMixin, EventHandler, XMPPFeatureHandler):
     presence.add_payload(x)
     self.send(presence)
 
+def delay_stamp(stanza):
+  '''the XEP-0203 delay stamp of `stanza`, or `None`'''
+  try:
+    return stanza.as_xml().find('{urn:xmpp:delay}delay').attrib['stamp']
+  except AttributeError:
+    return None
+
 def runit(settings, mysettings):
   bot = ChatBot(JID(config.jid), settings, mysettings)
+  # whether the process is going away, so no later flush will happen
+  final = False
   try:
     bot.run()
     # Connection resets
     raise Exception
   except SystemExit as e:
+    final = True
     if e.code == CMD_RESTART:
       # restart
+      bot.flush_burst()
       bot.disconnect()
+      flush_log_buffer(True)
       models.connection.disconnect()
       try:
         os.close(lock_fd[0])
@@ -472,11 +734,21 @@ def runit(settings, mysettings):
       logging.info('restart...')
       os.execv(sys.executable, [sys.executable] + sys.argv)
   except KeyboardInterrupt:
-    pass
+    final = True
   finally:
+    # a coalesced burst goes out, or to the outbox kept for the next bot
+    bot.flush_burst()
     ChatBot.message_queue = bot.message_queue
+    ChatBot.outbox = bot.outbox
+    flush_log_buffer(final)
     bot.disconnect()
 
+def flush_log_buffer(final):
+  '''flush `models.log_buffer`, retrying once; if `final`, entries that still
+  can't be written are logged'''
+  if not models.log_buffer.flush():
+    models.log_buffer.flush(final=final)
+
 def main():
   gp = models.connection.Group.one()
   if gp and gp.status:
@@ -0,0 +1,285 @@
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import datetime
+import time
+import bisect
+from collections import defaultdict, OrderedDict
+
+'''in-memory indexes of group members
+
+These mirror some fields of the user collection so that hot paths don't need
+a database round trip. They are (re)built in one pass when the roster is
+received, and whoever changes the corresponding fields in the database should
+update them as well.
+'''
+
+logger = logging.getLogger(__name__)
+
+class ReceiverIndex:
+  '''who should receive messages from whom
+
+  All jids are plain (bare) jids as `str`.'''
+  def __init__(self):
+    self.loaded = False
+    self.members = set()
+    # jid -> stop_until, only for those who may still be stopped
+    self.stopped = {}
+    # jid -> mute_until, likewise; muted members still receive messages
+    self.muted = {}
+    # jid -> jids of people he blocks
+    self.blocking = {}
+    # jid -> jids of people who block him
+    self.blockers = defaultdict(set)
+
+  def load(self, users):
+    '''(re)build the index from an iterable of user documents'''
+    self.members.clear()
+    self.stopped.clear()
+    self.muted.clear()
+    self.blocking.clear()
+    self.blockers.clear()
+    for u in users:
+      self.add(u['jid'], u.get('stop_until'), u.get('badpeople'),
+               u.get('mute_until'))
+    self.loaded = True
+    logger.info('receiver index loaded with %d members', len(self.members))
+
+  def add(self, jid, stop_until=None, badpeople=None, mute_until=None):
+    self.members.add(jid)
+    self.set_stop(jid, stop_until)
+    self.set_mute(jid, mute_until)
+    for bad in badpeople or ():
+      self.block(jid, bad)
+
+  def remove(self, jid):
+    self.members.discard(jid)
+    self.stopped.pop(jid, None)
+    self.muted.pop(jid, None)
+    for bad in self.blocking.pop(jid, ()):
+      s = self.blockers[bad]
+      s.discard(jid)
+      if not s:
+        del self.blockers[bad]
+
+  def set_stop(self, jid, stop_until):
+    if stop_until is None or stop_until <= datetime.datetime.utcnow():
+      self.stopped.pop(jid, None)
+    else:
+      self.stopped[jid] = stop_until
+
+  def set_mute(self, jid, mute_until):
+    if mute_until is None or mute_until <= datetime.datetime.utcnow():
+      self.muted.pop(jid, None)
+    else:
+      self.muted[jid] = mute_until
+
+  def block(self, jid, bad):
+    self.blocking.setdefault(jid, set()).add(bad)
+    self.blockers[bad].add(jid)
+
+  def receivers(self, online, now, sender=None):
+    '''filter `online` (an iterable of `JID`s) to those who should receive
+    messages from `sender` at the time `now`'''
+    members = self.members
+    excluded = set()
+    expired = []
+    for jid, until in self.stopped.items():
+      if until > now:
+        excluded.add(jid)
+      else:
+        expired.append(jid)
+    for jid in expired:
+      del self.stopped[jid]
+
+    if sender is not None and sender in self.blockers:
+      excluded |= self.blockers[sender]
+    return [u for u in online
+            if str(u) in members and str(u) not in excluded]
+
+class Leaderboard:
+  '''members ordered by activity, most active first
+
+  This is kept up to date as messages are counted, so listing a page of it
+  needs neither a database query nor a sort.'''
+  def __init__(self):
+    self.loaded = False
+    # sorted list of keys, see `_key`
+    self.ranking = []
+    # jid -> [nick, msg_count, msg_chars]
+    self.users = {}
+
+  def __len__(self):
+    return len(self.ranking)
+
+  @staticmethod
+  def _key(jid, info):
+    nick, count, chars = info
+    return (-count, -chars, nick or '', jid)
+
+  def load(self, users):
+    '''(re)build from an iterable of user documents'''
+    self.users = {
+      u['jid']: [u.get('nick'), u.get('msg_count') or 0, u.get('msg_chars') or 0]
+      for u in users
+    }
+    self.ranking = sorted(self._key(jid, info) for jid, info in self.users.items())
+    self.loaded = True
+
+  def add(self, jid, nick=None, msg_count=0, msg_chars=0):
+    if jid in self.users:
+      self.remove(jid)
+    info = self.users[jid] = [nick, msg_count, msg_chars]
+    bisect.insort(self.ranking, self._key(jid, info))
+
+  def remove(self, jid):
+    info = self.users.pop(jid, None)
+    if info is None:
+      return
+    ranking = self.ranking
+    del ranking[bisect.bisect_left(ranking, self._key(jid, info))]
+
+  def _update(self, jid, nick, count, chars):
+    try:
+      info = self.users[jid]
+    except KeyError:
+      return
+    ranking = self.ranking
+    del ranking[bisect.bisect_left(ranking, self._key(jid, info))]
+    info[:] = nick, count, chars
+    bisect.insort(ranking, self._key(jid, info))
+
+  def set_nick(self, jid, nick):
+    info = self.users.get(jid)
+    if info is not None:
+      self._update(jid, nick, info[1], info[2])
+
+  def increase(self, jid, chars):
+    '''count a message of `chars` characters'''
+    info = self.users.get(jid)
+    if info is not None:
+      self._update(jid, info[0], info[1] + 1, info[2] + chars)
+
+  def entries(self, start=0, stop=None, nick_filter=None):
+    '''yield (rank, jid, nick, msg_count, msg_chars) from `start` to `stop`
+    (0-based, counted after filtering)
+
+    `nick` may be `None` if the user has no nick yet.'''
+    if not nick_filter:
+      for rank, (__, __, __, jid) in enumerate(self.ranking[start:stop], start+1):
+        yield (rank, jid) + tuple(self.users[jid])
+      return
+
+    n = 0
+    for rank, (__, __, __, jid) in enumerate(self.ranking, 1):
+      nick, count, chars = self.users[jid]
+      if nick is None or nick.find(nick_filter) == -1:
+        continue
+      if stop is not None and n >= stop:
+        break
+      if n >= start:
+        yield rank, jid, nick, count, chars
+      n += 1
+
+  def count(self, nick_filter=None):
+    if not nick_filter:
+      return len(self.ranking)
+    return sum(1 for nick, __, __ in self.users.values()
+               if nick is not None and nick.find(nick_filter) != -1)
+
+class NickDirectory:
+  '''jid <-> nick mapping
+
+  Unlike a cache, this is written through on every nick change, so it never
+  needs to be cleared.'''
+  def __init__(self):
+    self.loaded = False
+    # jid -> nick
+    self.nicks = {}
+    # nick -> jid
+    self.jids = {}
+
+  def __contains__(self, nick):
+    return nick in self.jids
+
+  def load(self, users):
+    '''(re)build from an iterable of user documents'''
+    self.nicks.clear()
+    self.jids.clear()
+    for u in users:
+      self.set(u['jid'], u.get('nick'))
+    self.loaded = True
+
+  def get(self, jid):
+    '''return the nick of `jid`, or `None` if unknown'''
+    return self.nicks.get(jid)
+
+  def get_jid(self, nick):
+    return self.jids.get(nick)
+
+  def set(self, jid, nick):
+    self.remove(jid)
+    if nick is not None:
+      self.nicks[jid] = nick
+      self.jids[nick] = jid
+
+  def remove(self, jid):
+    old = self.nicks.pop(jid, None)
+    if old is not None and self.jids.get(old) == jid:
+      del self.jids[old]
+
+class IdentityMap:
+  '''a bounded map of jid -> `User` document
+
+  Least recently used entries are dropped when there are more than `size`
+  of them, and entries older than `ttl` seconds are reloaded. Code that
+  changes a user in the database without updating the document in place
+  should `invalidate` it.'''
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    # jid -> (user, time loaded)
+    self.users = OrderedDict()
+
+  def __len__(self):
+    return len(self.users)
+
+  def get(self, jid):
+    try:
+      user, t = self.users[jid]
+    except KeyError:
+      return
+    if time.time() - t > self.ttl:
+      del self.users[jid]
+      return
+    self.users.move_to_end(jid)
+    return user
+
+  def put(self, jid, user):
+    users = self.users
+    users[jid] = user, time.time()
+    users.move_to_end(jid)
+    while len(users) > self.size:
+      users.popitem(last=False)
+
+  def invalidate(self, jid):
+    self.users.pop(jid, None)
+
+  def clear(self):
+    self.users.clear()
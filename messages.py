@@ -19,11 +19,13 @@
 import logging
 from functools import wraps
 import datetime
+import time
 import re
 
 import commands
 import config
 import models
+import metrics
 from models import logmsg
 from misc import *
 
@@ -38,11 +40,32 @@ It will try to get two iterables from the plugin package with the names
 
 Message handlers accept two argument: the bot itself and the message string.
 If the handler returns `True`, no further actions are done; if `str`, it's
-the new message that will be handled later.
+the new message that will be handled later. A handler that needs to wait for
+something may return `True` and call `deliver_message` when it's done.
 '''
 
 logger = logging.getLogger(__name__)
 _message_handles = []
+# time spent in each message handler
+handler_stats = CallStats()
+handler_latency = metrics.histogram(
+  'handler_latency', 'time spent handling a message')
+dispatch_latency = metrics.histogram(
+  'dispatch_latency', 'time spent dispatching a message')
+lost_message_page_size = getattr(config, 'lost_message_page_size', 100)
+# in seconds; 0 to disable
+coalesce_window = getattr(config, 'coalesce_window', 0) / 1000
+# don't make a coalesced message longer than a chunk of a long reply
+coalesce_max_chars = getattr(config, 'reply_chunk_size', 3000)
+coalesced_lines = metrics.counter(
+  'coalesced_lines', 'messages sent together with a previous one')
+flood_burst = getattr(config, 'flood_burst', 0)
+if flood_burst:
+  flood_buckets = TokenBuckets(flood_burst, getattr(config, 'flood_rate', 0.5))
+else:
+  flood_buckets = None
+flood_mute_time = datetime.timedelta(
+  seconds=getattr(config, 'flood_mute_time', 300))
 
 def message_handler_register(func):
   '''register a message handler
@@ -80,8 +103,7 @@ def give_help(self, msg):
 def check_auth(self, msg):
   '''check if the user has joined or not'''
   bare = self.current_jid.bare()
-  subscribers = [x.jid for x in self.roster if x.subscription == 'both']
-  if bare in subscribers:
+  if bare in self.subscribers:
     return False
 
   if config.private:
@@ -91,32 +113,111 @@ def check_auth(self, msg):
     self.subscribe(bare)
   return True
 
+def flood_control(self, msg):
+  '''mute those who send messages too fast for a while
+
+  Commands, and messages delivered late (e.g. kept by the server while we
+  were offline), are not counted.'''
+  if flood_buckets is None or self.current_late \
+     or msg.startswith(config.prefix):
+    return False
+  user = self.current_user
+  if int(user.flag) & PERM_GPADMIN or flood_buckets.take(user.jid):
+    return False
+
+  if self.now < user.mute_until:
+    left = int((user.mute_until - self.now).total_seconds()) + 1
+    self.reply(_('You are sending messages too fast, and are disallowed to speak for %s more') % seconds2time(left))
+    return True
+  until = self.now + flood_mute_time
+  logger.info('%s is flooding, muted until %s', user.jid, until)
+  self.user_set_mute(user, until)
+  t = (until + config.timezoneoffset).strftime(dateformat)
+  self.reply(_('You are sending messages too fast, and are disallowed to speak until %s') % t)
+  return True
+
+class Burst:
+  '''consecutive messages from one sender, to be sent as one'''
+  __slots__ = ('sender', 'receivers', 'lines', 'length')
+
+  def __init__(self, sender, receivers):
+    self.sender = sender
+    self.receivers = receivers
+    self.lines = []
+    self.length = 0
+
+  def add(self, msg):
+    self.lines.append(msg)
+    self.length += len(msg) + 1
+
 class MessageMixin:
-  def handle_message(self, msg, timestamp=None):
-    '''apply handlers; timestamp indicates a delayed messages'''
+  # see `coalesce_message`
+  pending_burst = None
+  # the timestamp of the message being handled, if any
+  current_timestamp = None
+  # whether the message being handled was sent a while ago, e.g. kept by the
+  # server while we were offline
+  current_late = False
+
+  def handle_message(self, msg, timestamp=None, late=False):
+    '''apply handlers; timestamp indicates a delayed messages, which is
+    shown with it; `late` marks one sent a while ago without showing that'''
+    self.current_timestamp = timestamp
+    self.current_late = late or bool(timestamp)
+    try:
+      self._handle_message(msg, timestamp)
+    finally:
+      self.current_timestamp = None
+      self.current_late = False
+
+  def _handle_message(self, msg, timestamp):
+    # each handler is timed for `handler_stats`, and all of them together
+    # for `handler_latency`
+    start = t = time.time()
     for h in _message_handles:
       ret = h(self, msg)
+      now = time.time()
+      handler_stats.record(h.__name__, now - t)
+      t = now
       if ret is True:
         break
       elif isinstance(ret, str):
         msg = ret
     else:
-      if self.now < self.current_user.mute_until:
-        t = (self.current_user.mute_until + \
-             config.timezoneoffset).strftime(dateformat)
-        self.reply(_('You are disallowed to speak until %s') % t)
-        return
-      msg = msg.strip()
-      if not msg:
-        return
-      self.user_update_msglog(msg)
-      msg = '[%s] ' % self.user_get_nick(str(self.current_jid.bare())) + msg
-      if self.current_user.stop_until > self.now:
-        self.user_reset_stop() # self.current_user is reloaded here
-      self.dispatch_message(msg, timestamp)
-
-  def dispatch_message(self, msg, timestamp=None, but=None):
-    '''dispatch message to group members, also log the message in database'''
+      self.deliver_message(msg, timestamp)
+      now = time.time()
+      handler_stats.record('deliver_message', now - t)
+    handler_latency.observe(now - start)
+
+  def deliver_message(self, msg, timestamp=None):
+    '''standard handling of a message that has passed all handlers
+
+    Handlers that finish their work later (e.g. after some network request)
+    can return `True` and call this themselves.'''
+    if self.now < self.current_user.mute_until:
+      t = (self.current_user.mute_until + \
+           config.timezoneoffset).strftime(dateformat)
+      self.reply(_('You are disallowed to speak until %s') % t)
+      return
+    msg = msg.strip()
+    if not msg:
+      return
+    self.user_update_msglog(msg)
+    msg = '[%s] ' % self.user_get_nick(str(self.current_jid.bare())) + msg
+    if self.current_user.stop_until > self.now:
+      self.user_reset_stop() # self.current_user is reloaded here
+    self.dispatch_message(msg, timestamp, coalesce=True)
+
+  def dispatch_message(self, msg, timestamp=None, but=None, coalesce=False):
+    '''dispatch message to group members, also log the message in database
+
+    If `coalesce` and `coalesce_window` is set, it may be sent later
+    together with the following ones from the same sender.'''
+    with dispatch_latency.time():
+      return self._dispatch_message(msg, timestamp, but, coalesce)
+
+  def _dispatch_message(self, msg, timestamp, but, coalesce):
+    coalesce = coalesce and coalesce_window and but is None and not timestamp
     if but is None:
       but = {self.current_user.jid}
 
@@ -130,30 +231,79 @@ class MessageMixin:
         msg = '(%s) ' % dt.strftime(timeformat) + msg
 
     logmsg(self.current_jid, msg)
-    for u in self.get_message_receivers():
-      if str(u) not in but:
-        self.send_message(u, msg)
+    if coalesce:
+      self.coalesce_message(msg, but)
+      return True
+    # keep messages in order
+    self.flush_burst()
+    self.send_message_many(
+      (u for u in self.get_message_receivers() if str(u) not in but), msg)
     return True
 
+  def coalesce_message(self, msg, but):
+    '''send `msg` together with the following messages from the same
+    sender in `coalesce_window` seconds, as one multi-line message'''
+    sender = str(self.current_jid.bare())
+    burst = self.pending_burst
+    if burst is not None and (burst.sender != sender
+                              or burst.length + len(msg) > coalesce_max_chars):
+      self.flush_burst()
+      burst = None
+
+    if burst is None:
+      receivers = [u for u in self.get_message_receivers() if str(u) not in but]
+      burst = self.pending_burst = Burst(sender, receivers)
+      self.delayed_call(coalesce_window, self.flush_burst, burst)
+    else:
+      coalesced_lines.inc()
+    burst.add(msg)
+
+  def flush_burst(self, burst=None):
+    '''send the pending burst of messages now; if `burst` is given, only if
+    it's the pending one'''
+    pending = self.pending_burst
+    if pending is None or (burst is not None and burst is not pending):
+      return
+    self.pending_burst = None
+    self.send_message_many(pending.receivers, '\n'.join(pending.lines))
+
   def get_message_receivers(self):
-    q = {
-      'stop_until': {'$lte': self.now},
-    }
+    if not self.receiver_index.loaded:
+      self.user_load_index()
     if getattr(config, 'blockable', False):
-      q['badpeople'] = {'$ne': str(self.current_jid.bare())}
-    allusers = {u['jid'] for u in
-                models.connection.User.find(q, ['jid'])}
-    return [u for u in self.get_online_users() if str(u) in allusers]
+      sender = str(self.current_jid.bare())
+    else:
+      sender = None
+    return self.receiver_index.receivers(
+      self.get_online_users(), self.now, sender)
 
   def send_lost_message(self):
     if self.now <= self.current_user.stop_until:
       return
 
-    q = models.connection.Log.find(9999, self.current_user.last_seen)
+    cursor = self.current_user.last_seen, 0
+    self.send_lost_page(cursor, _('Messages while you lost the connection:'))
+
+  def send_lost_more(self):
+    '''continue `send_lost_message`; return `False` if there is no more'''
+    plainjid = str(self.current_jid.bare())
+    try:
+      cursor = self.lost_message_cursors.pop(plainjid)
+    except KeyError:
+      return False
+    return self.send_lost_page(cursor, _('More messages while you lost the connection:'))
+
+  def send_lost_page(self, cursor, header):
+    '''send a page of messages from `cursor` to the current user, and
+    remember where to continue'''
+    size = lost_message_page_size
+    q = models.connection.Log.find_page(cursor, size + 1)
     if not q:
-      return
+      return False
+    more = len(q) > size
+    q = q[:size]
 
-    text = [_('Messages while you lost the connection:')]
+    text = [header]
     for l in q:
       try:
         m = '%s %s' % (
@@ -164,7 +314,14 @@ class MessageMixin:
         logger.warning('malformed log messages: %r', l)
         continue
       text.append(m)
-    self.reply('\n'.join(text))
+
+    if more:
+      cursors = self.lost_message_cursors
+      cursors.expire()
+      cursors[str(self.current_jid.bare())] = models.next_cursor(cursor, q)
+      text.append(_('There are more messages. Send "%smore" to see them.') % config.prefix)
+    self.send_chunked(self.current_jid, text)
+    return True
 
 try:
   from plugin import message_plugin_early
@@ -175,6 +332,7 @@ except ImportError:
 
 # these are standard message plugins that normally desired
 message_handler_register(check_auth)
+message_handler_register(flood_control)
 message_handler_register(pingpong)
 message_handler_register(give_help)
 message_handler_register(command)
@@ -0,0 +1,154 @@
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+import time
+import bisect
+import contextlib
+
+'''lightweight metrics
+
+Counters, gauges and fixed-bucket histograms, registered by name. Get them
+once at import time and keep a reference; updating one only touches a few
+attributes so they are fine on hot paths.
+'''
+
+# in seconds
+LATENCY_BUCKETS = (
+  0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_registry = {}
+
+class Counter:
+  __slots__ = ('name', 'doc', 'value')
+
+  def __init__(self, name, doc):
+    self.name = name
+    self.doc = doc
+    self.value = 0
+
+  def inc(self, n=1):
+    self.value += n
+
+  def reset(self):
+    self.value = 0
+
+  def report(self):
+    return '%s: %d' % (self.name, self.value)
+
+class Gauge:
+  __slots__ = ('name', 'doc', 'value')
+
+  def __init__(self, name, doc):
+    self.name = name
+    self.doc = doc
+    self.value = 0
+
+  def set(self, value):
+    self.value = value
+
+  def reset(self):
+    # a gauge tells the current state; nothing to reset
+    pass
+
+  def report(self):
+    return '%s: %s' % (self.name, self.value)
+
+class Histogram:
+  '''counts of observed values in fixed buckets
+
+  `counts[i]` is the count of values not greater than `bounds[i]`, but
+  greater than the previous bound; the last one counts what's left.'''
+  __slots__ = ('name', 'doc', 'bounds', 'counts', 'count', 'sum', 'max')
+
+  def __init__(self, name, doc, buckets):
+    self.name = name
+    self.doc = doc
+    self.bounds = tuple(buckets)
+    self.reset()
+
+  def reset(self):
+    self.counts = [0] * (len(self.bounds) + 1)
+    self.count = 0
+    self.sum = 0
+    self.max = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  @contextlib.contextmanager
+  def time(self):
+    '''observe the wall time spent in a `with` block'''
+    t = time.time()
+    try:
+      yield
+    finally:
+      self.observe(time.time() - t)
+
+  def percentile(self, p):
+    '''an upper bound of the `p`th percentile (0 < p <= 100)'''
+    if not self.count:
+      return 0
+    rank = self.count * p / 100
+    n = 0
+    for bound, c in zip(self.bounds, self.counts):
+      n += c
+      if n >= rank:
+        return bound
+    return self.max
+
+  def report(self):
+    if not self.count:
+      return '%s: n=0' % self.name
+    return '%s: n=%d, avg=%.4g, p50<=%g, p95<=%g, p99<=%g, max=%.4g' % (
+      self.name, self.count, self.sum / self.count,
+      self.percentile(50), self.percentile(95), self.percentile(99),
+      self.max,
+    )
+
+def _get(cls, name, *args):
+  try:
+    m = _registry[name]
+  except KeyError:
+    m = _registry[name] = cls(name, *args)
+  else:
+    if not isinstance(m, cls):
+      raise TypeError('metric %s is already a %s' % (name, type(m).__name__))
+  return m
+
+def counter(name, doc=''):
+  return _get(Counter, name, doc)
+
+def gauge(name, doc=''):
+  return _get(Gauge, name, doc)
+
+def histogram(name, doc='', buckets=LATENCY_BUCKETS):
+  return _get(Histogram, name, doc, buckets)
+
+def report():
+  '''return a line for each metric, sorted by name'''
+  return [_registry[name].report() for name in sorted(_registry)]
+
+def reset():
+  for m in _registry.values():
+    m.reset()
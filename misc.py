@@ -180,6 +180,78 @@ def hashjid(jid):
 escape_map = {}
 
 class Forbidden(Exception): pass
+
+class CallStats:
+  '''call count, total and max wall time of named things, e.g. handlers
+
+  If a `latency` histogram is given, every call is observed in it as well.'''
+  def __init__(self, latency=None):
+    # name -> [count, total seconds, max seconds]
+    self.stats = {}
+    self.latency = latency
+
+  def record(self, name, seconds):
+    if self.latency is not None:
+      self.latency.observe(seconds)
+    try:
+      st = self.stats[name]
+    except KeyError:
+      self.stats[name] = [1, seconds, seconds]
+      return
+    st[0] += 1
+    st[1] += seconds
+    if seconds > st[2]:
+      st[2] = seconds
+
+  def reset(self):
+    self.stats.clear()
+
+  def report(self):
+    '''return lines describing the stats, the most time-consuming first'''
+    ret = []
+    for name, (count, total, max_) in sorted(
+      self.stats.items(), key=lambda x: x[1][1], reverse=True):
+      ret.append('%s: %d calls, total %.1fms, avg %.2fms, max %.1fms' % (
+        name, count, total * 1000, total * 1000 / count, max_ * 1000))
+    return ret
+
+class TokenBuckets:
+  '''a token bucket for each key, holding at most `burst` tokens and refilled
+  at `rate` tokens per second'''
+  def __init__(self, burst, rate):
+    self.burst = burst
+    self.rate = rate
+    # key -> [tokens, time last updated]
+    self.buckets = {}
+    self._prune_at = 1000
+
+  def take(self, key, now=None):
+    '''take a token for `key`; return `False` if there is none'''
+    if now is None:
+      now = time.time()
+    try:
+      b = self.buckets[key]
+    except KeyError:
+      if len(self.buckets) >= self._prune_at:
+        self._prune(now)
+      self.buckets[key] = [self.burst - 1, now]
+      return True
+    tokens = min(self.burst, b[0] + (now - b[1]) * self.rate)
+    b[1] = now
+    if tokens < 1:
+      b[0] = tokens
+      return False
+    b[0] = tokens - 1
+    return True
+
+  def _prune(self, now):
+    '''forget buckets that have refilled; they are the same as new ones'''
+    full = [k for k, (tokens, t) in self.buckets.items()
+            if tokens + (now - t) * self.rate >= self.burst]
+    for k in full:
+      del self.buckets[k]
+    self._prune_at = max(1000, 2 * len(self.buckets))
+
 class Lex:
   def __init__(self, string):
     self.instream = io.StringIO(string)
@@ -313,6 +385,32 @@ def execution_timeout(timeout):
   signal.setitimer(signal.ITIMER_REAL, *old_itimer)
   signal.signal(signal.SIGALRM, old_hdl)
 
+def split_chunks(lines, size):
+  '''join `lines` into chunks of at most `size` characters
+
+  Lines longer than `size` are split.'''
+  chunks = []
+  chunk = []
+  length = 0
+  for line in lines:
+    while len(line) > size:
+      if chunk:
+        chunks.append('\n'.join(chunk))
+        chunk = []
+        length = 0
+      chunks.append(line[:size])
+      line = line[size:]
+    # count in the newline
+    if chunk and length + len(line) + 1 > size:
+      chunks.append('\n'.join(chunk))
+      chunk = []
+      length = 0
+    length += len(line) + bool(chunk)
+    chunk.append(line)
+  if chunk:
+    chunks.append('\n'.join(chunk))
+  return chunks
+
 def is_russian(s):
   score = 0
   for ch in s:
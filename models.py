@@ -20,17 +20,29 @@ import re
 import datetime
 import unicodedata
 import logging
-
-from pymongo.errors import DuplicateKeyError, OperationFailure
-from mongokit import Connection
-from mongokit import Document as Doc
-from mongokit.schema_document import ValidationError
+import bisect
 
 from misc import *
 import config
+import metrics
+from search import SearchIndex
+
+# 'mongodb' or 'sqlite'
+storage = getattr(config, 'storage', 'mongodb')
+if storage == 'sqlite':
+  from sqlitestore import Connection, DuplicateKeyError, OperationFailure
+  from sqlitestore import Document as Doc
+  from sqlitestore import ValidationError
+else:
+  from pymongo.errors import DuplicateKeyError, OperationFailure
+  from mongokit import Connection
+  from mongokit import Document as Doc
+  from mongokit.schema_document import ValidationError
 
 logger = logging.getLogger(__name__)
 collection_prefix = getattr(config, 'connection_prefix', '')
+db_latency = metrics.histogram('db_latency', 'time spent in database calls')
+log_entries = metrics.counter('log_entries', 'log entries written')
 
 def validate_jid(jid):
   if not re_jid.match(jid):
@@ -148,19 +160,64 @@ class Log(Document):
   def find(self, n, in_=None):
     '''
     find `n` recent messages in `in_` minutes in chronological order.
+
+    `in_` can also be a `datetime`, after which to find messages.
     '''
     if in_ is not None:
       if isinstance(in_, datetime.datetime):
         after = in_
       else:
         after = datetime.datetime.utcnow() - datetime.timedelta(minutes=in_)
+    else:
+      after = None
+    l = log_ring.find(n, after)
+    if l is None:
+      l = self.find_in_db(n, after)
+    return l
+
+  def find_in_db(self, n, after=None):
+    '''like `find`, but always query the collection'''
+    if after is not None:
       query = {'time': {'$gt': after}}
     else:
       query = None
-    l = list(super().find(query).sort('$natural', -1).limit(n))
+    log_buffer.flush()
+    with db_latency.time():
+      l = list(super().find(query).sort('$natural', -1).limit(n))
     l.reverse()
     return l
 
+  def find_page(self, cursor, n):
+    '''
+    find at most `n` messages from `cursor` in chronological order.
+
+    `cursor` is a (time, skip) tuple: messages at `time` are included except
+    the first `skip` ones. Use `next_cursor` to get the cursor for the next
+    page.
+    '''
+    l = log_ring.page(cursor, n)
+    if l is None:
+      after, skip = cursor
+      log_buffer.flush()
+      with db_latency.time():
+        l = list(super().find({'time': {'$gte': after}})
+                 .sort('$natural', 1).skip(skip).limit(n))
+    return l
+
+def next_cursor(cursor, page):
+  '''the cursor after `page`, which is found by `Log.find_page(cursor, n)`'''
+  if not page:
+    return cursor
+  t = page[-1].time
+  skip = 0
+  for l in reversed(page):
+    if l.time != t:
+      break
+    skip += 1
+  if t == cursor[0]:
+    skip += cursor[1]
+  return t, skip
+
 class Group(Document):
   __collection__ = collection_prefix + 'group'
   use_schemaless = True
@@ -171,6 +228,16 @@ class Group(Document):
 
 def init():
   global connection
+  if storage == 'sqlite':
+    connection = Connection(getattr(config, 'sqlite_dir', '.'))
+  else:
+    connection = connect_mongodb()
+  connection.register([User, Log, Group])
+  entries = connection.Log.find_in_db(max(log_ring.size, search_index.size))
+  log_ring.seed(entries)
+  search_index.load(entries)
+
+def connect_mongodb():
   logger.info('connecting to database...')
   conn_args = getattr(config, 'connection', {})
   connection = Connection(**conn_args)
@@ -184,10 +251,136 @@ def init():
   except OperationFailure:
     logger.error('database authentication failed')
     raise
-  connection.register([User, Log, Group])
+  return connection
+
+class LogBuffer:
+  '''write-behind buffer for `Log` entries
+
+  Entries are inserted in one batch when `size` of them are pending, or when
+  `flush` is called, which the bot does periodically and before exiting.
+  Entries that fail to be inserted are kept for the next flush, but at most
+  `max_pending` of them.'''
+  def __init__(self, size, max_pending=None):
+    self.size = size
+    self.max_pending = max_pending or 100 * size
+    self.pending = []
+
+  def append(self, doc):
+    self.pending.append(doc)
+    if len(self.pending) >= self.size:
+      self.flush()
+
+  def flush(self, final=False):
+    '''insert pending entries; return whether all are written
+
+    If `final`, entries that can't be written are logged, since there won't
+    be another chance.'''
+    if not self.pending:
+      return True
+    docs, self.pending = self.pending, []
+    try:
+      with db_latency.time():
+        try:
+          connection.Log.collection.insert(docs)
+          written = len(docs)
+        except DuplicateKeyError:
+          # an earlier attempt got part of them written; pymongo has already
+          # given each an `_id`, so the rest can be told apart
+          written = self._insert_each(docs)
+    except Exception:
+      logger.exception('failed to write %d log entries', len(docs))
+      if final:
+        self._lost(docs)
+        return False
+      # put them back before what's appended in the meantime
+      self.pending[:0] = docs
+      extra = len(self.pending) - self.max_pending
+      if extra > 0:
+        self._lost(self.pending[:extra])
+        del self.pending[:extra]
+      return False
+    else:
+      log_entries.inc(written)
+      return True
+
+  def _insert_each(self, docs):
+    '''insert `docs` one by one, skipping those already there; return how
+    many are inserted'''
+    written = 0
+    for doc in docs:
+      try:
+        connection.Log.collection.insert(doc)
+      except DuplicateKeyError:
+        continue
+      written += 1
+    return written
+
+  def _lost(self, docs):
+    for doc in docs:
+      logger.error('log entry lost: %s %s %s',
+                   doc.get('time'), doc.get('jid'), doc.get('msg'))
+
+class LogRing:
+  '''recent `Log` entries in memory, in chronological order
+
+  It's seeded from the collection at startup and appended with every new
+  entry, so that most history lookups don't need to query the collection.
+  '''
+  def __init__(self, size):
+    self.size = size
+    self.entries = []
+    self.times = []
+    # whether we have every entry since the collection was empty
+    self.complete = False
+
+  def seed(self, entries):
+    self.entries = list(entries)[-self.size:]
+    self.times = [l.time for l in self.entries]
+    self.complete = len(self.entries) < self.size
+    logger.info('%d log entries loaded', len(self.entries))
+
+  def append(self, entry):
+    self.entries.append(entry)
+    self.times.append(entry.time)
+    if len(self.entries) > 2 * self.size:
+      del self.entries[:-self.size]
+      del self.times[:-self.size]
+      self.complete = False
+
+  def find(self, n, after=None):
+    '''find at most `n` recent entries after `after` (a `datetime`), in
+    chronological order
+
+    return `None` if this can't be answered without the collection.'''
+    if n <= 0:
+      return
+    times = self.times
+    start = 0 if after is None else bisect.bisect_right(times, after)
+    if len(times) - start >= n:
+      return self.entries[-n:]
+    if self.complete or (after is not None and times and times[0] <= after):
+      return self.entries[start:]
+
+  def page(self, cursor, n):
+    '''see `Log.find_page`; return `None` if this can't be answered without
+    the collection.'''
+    after, skip = cursor
+    times = self.times
+    if not (self.complete or (times and times[0] < after)):
+      return
+    start = bisect.bisect_left(times, after)
+    start = min(start + skip, bisect.bisect_right(times, after))
+    return self.entries[start:start+n]
+
+log_buffer = LogBuffer(getattr(config, 'log_flush_size', 100))
+log_ring = LogRing(getattr(config, 'log_cache_size', 5000))
+search_index = SearchIndex(getattr(config, 'search_index_size', 50000))
 
 def logmsg(jid=None, msg=None):
   u = connection.Log()
   u.jid = str(jid)
   u.msg = msg
-  u.save()
+  u.validate()
+  log_buffer.append(u)
+  log_ring.append(u)
+  search_index.add(u)
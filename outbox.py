@@ -0,0 +1,107 @@
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+from collections import OrderedDict, deque
+
+import metrics
+
+'''messages waiting to be written to the stream
+
+Messages go here when the stream can't take them right away, and are written
+out by the main loop as the stream becomes writable, one for each recipient
+in turn so that a long backlog for some doesn't hold up the others.
+'''
+
+outbox_depth = metrics.gauge('outbox_depth', 'messages waiting to be written')
+outbox_recipients = metrics.gauge(
+  'outbox_recipients', 'recipients with messages waiting')
+outbox_dropped = metrics.counter(
+  'outbox_dropped', 'messages dropped for backlogged recipients')
+
+class Outgoing:
+  '''a message body to send, possibly to many recipients
+
+  `parts` caches the stanza serialized for `stream`, split before the end of
+  the start tag; see `ChatBot._stanza_parts`.'''
+  __slots__ = ('body', 'stream', 'parts')
+
+  def __init__(self, body):
+    self.body = body
+    self.stream = self.parts = None
+
+class Outbox:
+  '''a bounded queue of `Outgoing` messages for each recipient
+
+  When a queue is full, its oldest message is dropped and counted, so that
+  the recipient can be told about it later.'''
+  def __init__(self, max_depth):
+    self.max_depth = max_depth
+    # recipient -> deque of messages, in the order to take from
+    self.queues = OrderedDict()
+    # recipient -> messages dropped since the last `pop` for it
+    self.dropped = {}
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def depth(self, recipient):
+    q = self.queues.get(recipient)
+    return len(q) if q else 0
+
+  def put(self, recipient, entry):
+    try:
+      q = self.queues[recipient]
+    except KeyError:
+      q = self.queues[recipient] = deque()
+      outbox_recipients.set(len(self.queues))
+    if len(q) >= self.max_depth:
+      q.popleft()
+      self.dropped[recipient] = self.dropped.get(recipient, 0) + 1
+      outbox_dropped.inc()
+    else:
+      self.size += 1
+      outbox_depth.set(self.size)
+    q.append(entry)
+
+  def pop(self):
+    '''return (recipient, message, dropped) from the next recipient in turn,
+    where `dropped` is how many messages to it have been dropped since last
+    time'''
+    recipient, q = self.queues.popitem(last=False)
+    entry = q.popleft()
+    if q:
+      self.queues[recipient] = q
+    else:
+      outbox_recipients.set(len(self.queues))
+    self.size -= 1
+    outbox_depth.set(self.size)
+    return recipient, entry, self.dropped.pop(recipient, 0)
+
+  def push_back(self, recipient, entry, dropped):
+    '''undo a `pop` whose message couldn't be written'''
+    q = self.queues.get(recipient)
+    if q is None:
+      q = self.queues[recipient] = deque()
+      outbox_recipients.set(len(self.queues))
+    self.queues.move_to_end(recipient, last=False)
+    q.appendleft(entry)
+    self.size += 1
+    outbox_depth.set(self.size)
+    if dropped:
+      self.dropped[recipient] = self.dropped.get(recipient, 0) + dropped
@@ -17,14 +17,20 @@
 # along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
 #
 import re
+import time
+import datetime
 import logging
 import urllib.request
 import urllib.parse
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import config
 
 logger = logging.getLogger(__name__)
+paste_timeout = getattr(config, 'paste_timeout', 10)
+# uploads are done here so that a slow paste service won't block the bot
+paste_executor = ThreadPoolExecutor(max_workers=2)
 
 re_youren = re.compile(r'有人在?吗.{,3}')
 re_link = re.compile(r' [(<]https?://(?!i.imgur.com/)[^>)]+[>)]')
@@ -44,8 +50,9 @@ filtered_message = {
 }
 
 def cache_clear(self, msg):
+  '''reload the in-memory member indexes after changing the database by hand'''
   if msg == 'cache_clear':
-    self.user_get_nick.cache_clear()
+    self.user_load_index()
     self.reply('ok.')
     return True
 
@@ -78,9 +85,12 @@ def remove_links(self, msg):
   return msg
 
 def post_code(msg):
-  '''将代码贴到网站，返回 URL 地址 或者 None（失败）'''
+  '''将代码贴到网站，返回 URL 地址 或者 None（失败）
+
+  在 `paste_executor` 的线程中运行'''
   try:
-    result = urllib.request.urlopen('https://pb.nichi.co/', msg.encode())
+    result = urllib.request.urlopen('https://pb.nichi.co/', msg.encode(),
+                                    timeout=paste_timeout)
     url = result.read().decode('utf-8').strip()
     return url
   except Exception:
@@ -88,27 +98,50 @@ def post_code(msg):
     return
 
 def long_text_check(self, msg):
+  '''长文本在后台贴到网站，完成后再转发'''
   if len(msg) > 500 or msg.count('\n') > 5:
-    msgbody = post_code(msg)
-    if msgbody:
-      self.reply('内容过长，已贴至 %s 。' % msgbody)
-      firstline = ''
-      lineiter = iter(msg.split('\n'))
-      try:
-        while not firstline:
-          firstline = next(lineiter)
-      except StopIteration:
-        pass
-      if len(firstline) > 40:
-        firstline = firstline[:40]
-      msgbody += '\n' + firstline + '...'
-      return msgbody
-    else:
-      logger.warning('转贴代码失败，代码长度 %d' % len(msg))
-      self.reply('大段文本请贴 paste 网站。\n'
-                 '如 http://paste.ubuntu.org.cn/ http://slexy.org/\n'
-                 'PS: 自动转帖失败！')
-      return True
+    future = paste_executor.submit(post_code, msg)
+    deadline = time.time() + paste_timeout
+    self.delayed_call(0.2, wait_for_paste, self, self.current_jid, msg,
+                      self.current_timestamp, future, deadline)
+    return True
+
+def wait_for_paste(self, jid, msg, timestamp, future, deadline):
+  if not future.done():
+    if time.time() < deadline:
+      self.delayed_call(0.2, wait_for_paste, self, jid, msg, timestamp,
+                        future, deadline)
+      return
+    future.cancel()
+    msgbody = None
+    logger.warning('转贴代码超时')
+  else:
+    msgbody = future.result()
+
+  if jid.bare() not in self.subscribers:
+    # left while we were uploading
+    return
+  self.current_jid = jid
+  self.now = datetime.datetime.utcnow()
+
+  if msgbody:
+    self.reply('内容过长，已贴至 %s 。' % msgbody)
+    firstline = ''
+    lineiter = iter(msg.split('\n'))
+    try:
+      while not firstline:
+        firstline = next(lineiter)
+    except StopIteration:
+      pass
+    if len(firstline) > 40:
+      firstline = firstline[:40]
+    msgbody += '\n' + firstline + '...'
+    self.deliver_message(msgbody, timestamp)
+  else:
+    logger.warning('转贴代码失败，代码长度 %d' % len(msg))
+    self.reply('大段文本请贴 paste 网站。\n'
+               '如 http://paste.ubuntu.org.cn/ http://slexy.org/\n'
+               'PS: 自动转帖失败！')
 
 message_plugin_early = [
 ]
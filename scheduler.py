@@ -0,0 +1,90 @@
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import datetime
+import heapq
+
+logger = logging.getLogger(__name__)
+# don't arm another timer just to fire this little earlier
+SLACK = datetime.timedelta(seconds=1)
+
+class ExpiryScheduler:
+  '''call `callback(key)` when the deadline for `key` has passed
+
+  A key has at most one deadline; scheduling it again replaces the old one.
+  Deadlines are UTC `datetime`s kept in a heap, and only one main-loop timer
+  is armed, for the earliest of them.
+
+  `delayed_call` is like `ChatBot.delayed_call`.'''
+  def __init__(self, delayed_call, callback):
+    self.delayed_call = delayed_call
+    self.callback = callback
+    # key -> deadline; entries in the heap not matching this are stale
+    self.deadlines = {}
+    self.heap = []
+    # the deadline the timer is armed for
+    self.armed = None
+
+  def __len__(self):
+    return len(self.deadlines)
+
+  def schedule(self, key, deadline):
+    self.deadlines[key] = deadline
+    heapq.heappush(self.heap, (deadline, key))
+    if len(self.heap) > 2 * len(self.deadlines) + 16:
+      self.heap = [(d, k) for k, d in self.deadlines.items()]
+      heapq.heapify(self.heap)
+    self._arm()
+
+  def cancel(self, key):
+    # the heap entry is left there and skipped later
+    self.deadlines.pop(key, None)
+
+  def _arm(self):
+    heap = self.heap
+    while heap and self.deadlines.get(heap[0][1]) != heap[0][0]:
+      heapq.heappop(heap)
+    if not heap:
+      return
+
+    deadline = heap[0][0]
+    if self.armed is not None and self.armed <= deadline + SLACK:
+      return
+    self.armed = deadline
+    seconds = (deadline - datetime.datetime.utcnow()).total_seconds()
+    self.delayed_call(max(seconds, 0), self._fire, deadline)
+
+  def _fire(self, deadline):
+    if self.armed != deadline:
+      # an earlier timer has been armed since
+      return
+    self.armed = None
+
+    heap = self.heap
+    now = datetime.datetime.utcnow()
+    while heap and heap[0][0] <= now:
+      deadline, key = heapq.heappop(heap)
+      if self.deadlines.get(key) != deadline:
+        continue
+      del self.deadlines[key]
+      try:
+        self.callback(key)
+      except Exception:
+        logger.exception('error while handling expiry of %r', key)
+    self._arm()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf-8
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''fan-out throughput benchmark
+
+Run from the top directory with a working config.py. The bot is driven
+through `ChatBot.message_received` and the presence handlers as if it were
+connected; stanzas go to a sink that only serializes and counts them, and
+delayed calls are run right away. The data lives in a scratch database
+which is dropped before and after each run.
+'''
+
+import sys
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, '.')
+
+import config
+
+class FakeTransport:
+  '''counts what's written instead of sending it'''
+  def __init__(self):
+    from pyxmpp2.xmppserializer import XMPPSerializer
+    self.lock = threading.RLock()
+    self._eof = False
+    # something always writable for `ChatBot.stream_writable`
+    self._socket, self._peer = socket.socketpair()
+    self._serializer = XMPPSerializer('jabber:client')
+    self._serializer.emit_head(None, 'bench.invalid')
+    self.stanzas = 0
+    self.bytes = 0
+
+  def _write(self, data):
+    self.stanzas += 1
+    self.bytes += len(data)
+
+  def send_element(self, element):
+    with self.lock:
+      self._write(self._serializer.emit_stanza(element).encode('utf-8'))
+
+class FakeStream:
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.transport = FakeTransport()
+
+  def fix_out_stanza(self, stanza):
+    stanza.from_jid = None
+
+  def send(self, stanza):
+    with self.lock:
+      self.fix_out_stanza(stanza)
+      self.transport.send_element(stanza.as_xml())
+
+class FakeMainLoop:
+  '''collects delayed calls; `run_pending` runs the short ones right away'''
+  def __init__(self):
+    self.calls = []
+
+  def delayed_call(self, delay, function):
+    self.calls.append((delay, function))
+
+  def remove_handler(self, handler):
+    # called by pyxmpp2 on teardown; nothing is registered here
+    pass
+
+  def run_pending(self, max_delay=1):
+    while True:
+      ready = [f for d, f in self.calls if d <= max_delay]
+      if not ready:
+        return
+      self.calls = [(d, f) for d, f in self.calls if d > max_delay]
+      for f in ready:
+        f()
+
+def percentile(sorted_data, p):
+  return sorted_data[min(len(sorted_data) * p // 100, len(sorted_data) - 1)]
+
+def report(name, latencies, stanzas, unit='messages'):
+  total = sum(latencies)
+  latencies = sorted(latencies)
+  n = len(latencies)
+  print('%-10s %6d %s in %7.3fs: %9.1f %s/s, %9.1f stanzas/s; '
+        'latency p50 %.2fms, p95 %.2fms, max %.2fms' % (
+          name, n, unit, total, n / total, unit, stanzas / total,
+          percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+          latencies[-1] * 1000))
+
+def setup_database(members, domain='bench.invalid'):
+  '''(re)create the scratch database with `members` users and return their
+  jids'''
+  import models
+  import dbman
+
+  jids = ['bench%d@%s' % (i, domain) for i in range(members)]
+  models.connection.drop_database(config.database)
+  dbman.setup_user_collection()
+  dbman.setup_log_collection()
+  dbman.setup_group_collection()
+
+  users = []
+  for i, jid in enumerate(jids):
+    u = models.connection.User()
+    u.jid = jid
+    u.nick = 'bench%d' % i
+    u.validate()
+    users.append(u)
+  models.connection.User.collection.insert(users)
+  models.log_ring.seed(())
+  return jids
+
+class Bench:
+  def __init__(self, members):
+    from pyxmpp2.jid import JID
+    from pyxmpp2.presence import Presence
+    from pyxmpp2.settings import XMPPSettings
+    from pyxmpp2.roster import Roster, RosterItem
+    from main import ChatBot
+
+    self.members = setup_database(members)
+    bot = self.bot = ChatBot(
+      JID(config.jid), XMPPSettings({}), {'presence': Presence()})
+    bot.jid = bot.client.jid.bare()
+    bot.update_on_setstatus = set()
+    bot.client.stream = self.stream = FakeStream()
+    bot.client.main_loop = self.main_loop = FakeMainLoop()
+    bot.client.roster_client.roster = Roster(
+      [RosterItem(JID(jid), subscription='both') for jid in self.members])
+    bot.roster_received(None)
+    bot.handle_early_message()
+
+  @property
+  def stanzas(self):
+    return self.stream.transport.stanzas
+
+  def presence_storm(self):
+    from pyxmpp2.jid import JID
+    from pyxmpp2.presence import Presence
+    latencies = []
+    start = self.stanzas
+    for jid in self.members:
+      p = Presence(from_jid=JID(jid + '/bench'), to_jid=self.bot.jid, priority=0)
+      t = time.time()
+      self.bot.handle_presence_available(p)
+      latencies.append(time.time() - t)
+    self.main_loop.run_pending()
+    report('presence', latencies, self.stanzas - start, 'presences')
+
+  def messages(self, name, n, body):
+    '''send `n` messages with `body(i)` as the i-th one'''
+    from pyxmpp2.jid import JID
+    from pyxmpp2.message import Message
+    latencies = []
+    start = self.stanzas
+    senders = self.members
+    for i in range(n):
+      sender = JID(senders[i % len(senders)] + '/bench')
+      m = Message(from_jid=sender, to_jid=self.bot.jid,
+                  stanza_type='chat', body=body(i))
+      t = time.time()
+      self.bot.message_received(m)
+      self.main_loop.run_pending()
+      latencies.append(time.time() - t)
+    report(name, latencies, self.stanzas - start)
+
+# commands to time in each run, without the prefix
+commands = ('online', 'old 100', 'users', 'search message')
+
+def main():
+  parser = argparse.ArgumentParser(description='xmpptalk fan-out benchmark')
+  parser.add_argument('--sizes', default='100,1000,10000',
+                      help='online members in each run (default: 100,1000,10000)')
+  parser.add_argument('-n', '--messages', type=int, default=200,
+                      help='chat messages to send in each run (default: 200)')
+  parser.add_argument('--database', default='xmpptalk_benchmark',
+                      help='scratch database to use; it will be dropped!')
+  args = parser.parse_args()
+
+  if args.database == config.database:
+    sys.exit('refusing to drop the real database %s' % config.database)
+  config.database = args.database
+  # don't try to set our vCard
+  config.nick = config.avatar_file = None
+  # before models is imported so that it uses the scratch database
+  import models
+  models.init()
+
+  for size in (int(x) for x in args.sizes.split(',')):
+    print('== %d online members ==' % size)
+    b = Bench(size)
+    b.presence_storm()
+    b.messages('dispatch', args.messages,
+               lambda i: 'hello, this is message %d' % i)
+    for cmd in commands:
+      body = config.prefix + cmd
+      b.messages('-' + cmd.split()[0], max(args.messages // 10, 1),
+                 lambda i: body)
+    models.log_buffer.flush()
+    models.connection.drop_database(config.database)
+
+if __name__ == '__main__':
+  main()
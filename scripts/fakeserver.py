@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# vim:fileencoding=utf-8
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+'''a local stand-in for an XMPP server, for load testing
+
+`FakeServer` listens on 127.0.0.1 and speaks just enough XMPP for
+`pyxmpp2.client.Client` to log in without TLS: SASL PLAIN (any password is
+accepted), resource binding and the roster. Everything the bot sends is
+recorded, and presences and messages from simulated users can be injected.
+
+Run from the top directory with a working config.py to load test the bot
+against it; the data lives in a scratch database which is dropped before and
+after the run. It can also be imported and driven by other scripts.
+'''
+
+import sys
+import time
+import base64
+import socket
+import argparse
+import threading
+import itertools
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+sys.path.insert(0, '.')
+
+STREAM_NS = 'http://etherx.jabber.org/streams'
+SASL_NS = 'urn:ietf:params:xml:ns:xmpp-sasl'
+BIND_NS = 'urn:ietf:params:xml:ns:xmpp-bind'
+ROSTER_NS = 'jabber:iq:roster'
+CLIENT_NS = 'jabber:client'
+
+class FakeServer:
+  '''serve one client connection at a time
+
+  `roster` is a list of bare jids which the bot will get with subscription
+  'both'. Stanzas from the bot are parsed into `ElementTree` elements and
+  appended to `received`; `counts` counts them by tag name, and `directed`
+  counts only those with a 'to' address.'''
+  def __init__(self, domain, roster=(), port=0):
+    self.domain = domain
+    self.roster = list(roster)
+    self.sock = socket.socket()
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.sock.bind(('127.0.0.1', port))
+    self.sock.listen(5)
+    self.port = self.sock.getsockname()[1]
+
+    self.received = []
+    self.counts = {'message': 0, 'presence': 0, 'iq': 0}
+    self.directed = dict(self.counts)
+    self.connections = 0
+    self.client_jid = None
+    # set when the roster is sent, cleared on disconnection
+    self.roster_served = threading.Event()
+    self.cond = threading.Condition()
+    self.conn = None
+    self.send_lock = threading.Lock()
+    self._ids = itertools.count()
+
+  def start(self):
+    t = threading.Thread(target=self._accept_loop, daemon=True)
+    t.start()
+
+  def _accept_loop(self):
+    while True:
+      conn, __ = self.sock.accept()
+      conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.connections += 1
+      self.conn = conn
+      t = threading.Thread(target=self._serve, args=(conn,), daemon=True)
+      t.start()
+
+  def _serve(self, conn):
+    session = _Session(self, conn)
+    try:
+      while True:
+        data = conn.recv(65536)
+        if not data or not session.feed(data):
+          break
+    except OSError:
+      pass
+    finally:
+      conn.close()
+      if self.conn is conn:
+        self.conn = None
+        self.roster_served.clear()
+      with self.cond:
+        self.cond.notify_all()
+
+  def _record(self, elem):
+    with self.cond:
+      self.received.append(elem)
+      tag = elem.tag.rsplit('}', 1)[-1]
+      self.counts[tag] = self.counts.get(tag, 0) + 1
+      if elem.get('to'):
+        self.directed[tag] = self.directed.get(tag, 0) + 1
+      self.cond.notify_all()
+
+  def wait_for(self, predicate, timeout=60):
+    '''wait until `predicate()` is true; return whether it is
+
+    It's checked whenever a stanza arrives, and at least every 0.1s.'''
+    deadline = time.time() + timeout
+    with self.cond:
+      while not predicate():
+        left = deadline - time.time()
+        if left <= 0:
+          return False
+        self.cond.wait(min(left, 0.1))
+    return True
+
+  def send(self, data, conn=None):
+    '''send raw XML to the client'''
+    conn = conn or self.conn
+    if conn is None:
+      raise ConnectionError('no client connected')
+    with self.send_lock:
+      conn.sendall(data.encode('utf-8'))
+
+  def drop(self):
+    '''close the client connection abruptly, as a broken network would'''
+    conn = self.conn
+    if conn is not None:
+      conn.shutdown(socket.SHUT_RDWR)
+
+  def next_id(self):
+    return 'fake%d' % next(self._ids)
+
+  def presence(self, jid, type=None, priority=0, status=None):
+    '''send a presence from full jid `jid` to the bot'''
+    attrs = ' type=%s' % quoteattr(type) if type else ''
+    children = '' if type else '<priority>%d</priority>' % priority
+    if status:
+      children += '<status>%s</status>' % escape(status)
+    self.send('<presence from=%s to=%s%s>%s</presence>' % (
+      quoteattr(jid), quoteattr(self.client_jid), attrs, children))
+
+  def message(self, jid, body, type='chat'):
+    '''send a message from full jid `jid` to the bot'''
+    self.send('<message from=%s to=%s type=%s id=%s><body>%s</body></message>' % (
+      quoteattr(jid), quoteattr(self.client_jid), quoteattr(type),
+      quoteattr(self.next_id()), escape(body)))
+
+  def roster_push(self, jid, subscription='both', ask=None):
+    '''add `jid` to the roster, or change its subscription'''
+    if subscription == 'remove':
+      self.roster = [j for j in self.roster if j != jid]
+    elif jid not in self.roster:
+      self.roster.append(jid)
+    ask = ' ask=%s' % quoteattr(ask) if ask else ''
+    self.send(
+      '<iq type="set" id=%s><query xmlns=%s><item jid=%s subscription=%s%s/>'
+      '</query></iq>' % (
+        quoteattr(self.next_id()), quoteattr(ROSTER_NS),
+        quoteattr(jid), quoteattr(subscription), ask))
+
+  def roster_xml(self):
+    return ''.join('<item jid=%s subscription="both"/>' % quoteattr(jid)
+                   for jid in self.roster)
+
+class _Session:
+  '''the state of a client connection'''
+  def __init__(self, server, conn):
+    self.server = server
+    self.conn = conn
+    self.authenticated = False
+    self.user = None
+    self._new_parser()
+
+  def _new_parser(self):
+    self.parser = ET.XMLPullParser(('start', 'end'))
+    self.depth = 0
+    self.root = None
+
+  def send(self, data):
+    self.server.send(data, self.conn)
+
+  def feed(self, data):
+    '''handle incoming data; return `False` when the stream is closed'''
+    parser = self.parser
+    parser.feed(data)
+    for event, elem in parser.read_events():
+      if event == 'start':
+        self.depth += 1
+        if self.depth == 1:
+          self.root = elem
+          self._stream_start()
+      else:
+        self.depth -= 1
+        if self.depth == 0:
+          self.send('</stream:stream>')
+          return False
+        if self.depth == 1:
+          self.root.remove(elem)
+          if not self._handle(elem):
+            return True
+    return True
+
+  def _stream_start(self):
+    self.send(
+      "<?xml version='1.0'?><stream:stream xmlns='%s' "
+      "xmlns:stream='%s' id='%s' from='%s' version='1.0'>" % (
+        CLIENT_NS, STREAM_NS, self.server.next_id(), self.server.domain))
+    if self.authenticated:
+      features = '<bind xmlns="%s"/>' % BIND_NS
+    else:
+      features = ('<mechanisms xmlns="%s"><mechanism>PLAIN</mechanism>'
+                  '</mechanisms>' % SASL_NS)
+    self.send('<stream:features>%s</stream:features>' % features)
+
+  def _handle(self, elem):
+    '''handle a top level element; return `False` if the parser has been
+    replaced, i.e. the stream restarts'''
+    if elem.tag == '{%s}auth' % SASL_NS:
+      authzid, user, password = base64.b64decode(
+        elem.text or '').decode('utf-8').split('\0')
+      self.user = user
+      self.authenticated = True
+      self.send('<success xmlns="%s"/>' % SASL_NS)
+      self._new_parser()
+      return False
+
+    if elem.tag == '{%s}iq' % CLIENT_NS:
+      self._handle_iq(elem)
+    self.server._record(elem)
+    return True
+
+  def _handle_iq(self, elem):
+    type = elem.get('type')
+    if type not in ('get', 'set'):
+      return
+    id = quoteattr(elem.get('id', ''))
+    bind = elem.find('{%s}bind' % BIND_NS)
+    query = elem.find('{%s}query' % ROSTER_NS)
+    server = self.server
+
+    if bind is not None:
+      resource = bind.findtext('{%s}resource' % BIND_NS) or 'fake'
+      server.client_jid = '%s@%s/%s' % (self.user, server.domain, resource)
+      self.send('<iq type="result" id=%s><bind xmlns=%s><jid>%s</jid></bind>'
+                '</iq>' % (id, quoteattr(BIND_NS), escape(server.client_jid)))
+    elif query is not None and type == 'get':
+      self.send('<iq type="result" id=%s><query xmlns=%s>%s</query></iq>' % (
+        id, quoteattr(ROSTER_NS), server.roster_xml()))
+      server.roster_served.set()
+    else:
+      # vCards, roster changes and the like: pretend they're fine
+      self.send('<iq type="result" id=%s/>' % id)
+
+class LoadTest:
+  def __init__(self, members, timeout):
+    from benchmark import setup_database
+    self.domain = 'fake.invalid'
+    self.members = setup_database(members, self.domain)
+    self.timeout = timeout
+    self.server = FakeServer(self.domain, self.members)
+    self.server.start()
+    self.bot = None
+    self.failed = []
+
+  def _run_bot(self):
+    from pyxmpp2.jid import JID
+    from pyxmpp2.presence import Presence
+    from pyxmpp2.settings import XMPPSettings
+    from main import ChatBot
+    import models
+
+    settings = XMPPSettings({
+      'server': '127.0.0.1',
+      'c2s_port': self.server.port,
+      'starttls': False,
+      'tls_require': False,
+      'insecure_auth': True,
+      'sasl_mechanisms': ['PLAIN'],
+      'password': 'fake',
+      'initial_presence': Presence(priority=30),
+      'poll_interval': 1,
+    })
+    self.bot = ChatBot(JID('bot@%s/fake' % self.domain), settings,
+                       {'presence': settings['initial_presence']})
+    try:
+      self.bot.run()
+    except Exception as e:
+      self.failed.append(e)
+    finally:
+      ChatBot.message_queue = self.bot.message_queue
+      ChatBot.outbox = self.bot.outbox
+      models.log_buffer.flush()
+
+  def connect(self):
+    t = time.time()
+    threading.Thread(target=self._run_bot, daemon=True).start()
+    if not self.server.roster_served.wait(self.timeout):
+      sys.exit('the bot did not log in in time')
+    # early messages are queued until a while after the roster is received
+    self.server.wait_for(lambda: self.bot.got_roster, self.timeout)
+    print('login     roster of %d served, ready in %.3fs' % (
+      len(self.members), time.time() - t))
+
+  def presence_storm(self):
+    server = self.server
+    since = server.directed['presence']
+    t = time.time()
+    for jid in self.members:
+      server.presence(jid + '/fake')
+    sent = time.time() - t
+    # the bot answers every presence with its own
+    ok = server.wait_for(
+      lambda: server.directed['presence'] - since >= len(self.members),
+      self.timeout)
+    total = time.time() - t
+    print('presence  %d presences sent in %.3fs, answered in %.3fs (%.1f/s)%s' % (
+      len(self.members), sent, total, len(self.members) / total,
+      '' if ok else ' TIMED OUT'))
+
+  def messages(self, n):
+    server = self.server
+    since = server.directed['message']
+    expected = n * (len(self.bot.get_online_users()) - 1)
+    t = time.time()
+    for i in range(n):
+      server.message(self.members[i % len(self.members)] + '/fake',
+                     'hello, this is message %d' % i)
+    ok = server.wait_for(
+      lambda: server.directed['message'] - since >= expected,
+      self.timeout)
+    total = time.time() - t
+    print('dispatch  %d messages, %d stanzas out in %.3fs (%.1f stanzas/s)%s' % (
+      n, expected, total, expected / total, '' if ok else ' TIMED OUT'))
+
+  def reconnect(self):
+    t = time.time()
+    self.server.drop()
+    self.server.wait_for(lambda: not self.server.roster_served.is_set(),
+                         self.timeout)
+    print('dropped   connection closed in %.3fs' % (time.time() - t))
+    self.connect()
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='load test xmpptalk against a local fake XMPP server')
+  parser.add_argument('--members', type=int, default=1000,
+                      help='simulated group members (default: 1000)')
+  parser.add_argument('-n', '--messages', type=int, default=50,
+                      help='chat messages to send (default: 50)')
+  parser.add_argument('--reconnects', type=int, default=1,
+                      help='times to drop the connection and start over (default: 1)')
+  parser.add_argument('--timeout', type=float, default=120,
+                      help='seconds to wait for the bot at each step (default: 120)')
+  parser.add_argument('--database', default='xmpptalk_loadtest',
+                      help='scratch database to use; it will be dropped!')
+  args = parser.parse_args()
+
+  import config
+  if args.database == config.database:
+    sys.exit('refusing to drop the real database %s' % config.database)
+  config.database = args.database
+  config.nick = config.avatar_file = None
+  import models
+  models.init()
+
+  lt = LoadTest(args.members, args.timeout)
+  try:
+    for i in range(args.reconnects + 1):
+      if i:
+        lt.reconnect()
+      else:
+        lt.connect()
+      lt.presence_storm()
+      lt.messages(args.messages)
+    for e in lt.failed:
+      print('the bot failed: %r' % e)
+    print('received from the bot: %s' % ', '.join(
+      '%d %s' % (v, k) for k, v in sorted(lt.server.counts.items())))
+  finally:
+    models.log_buffer.flush()
+    models.connection.drop_database(config.database)
+
+if __name__ == '__main__':
+  main()
@@ -20,77 +20,148 @@
 #
 
 import re
-import time
 import sys
+import gzip
+import time
+import argparse
+from array import array
 from collections import defaultdict
 
-re_color = re.compile(r'\[[0-9;]*[mK]|')
+'''how long does it take to handle each type of message?
+
+Log files are read line by line so they can be of any size. Rotated ones may
+be gzipped; give them oldest first.
+'''
+
+re_color = re.compile('\x1b\\[[0-9;]*[mK]|\x0f')
 re_ping = re.compile(r'\[[^]]+\] ping$')
 re_test = re.compile(r'\[[^]]+\]\s+(test|测试)\s*$')
 re_cmd = re.compile(r'\[[^]]+\] -(\w+)')
 re_other_msg = re.compile(r'\[[^]]+\] ')
 
-year = time.gmtime().tm_year
+class Timestamps:
+  '''convert log timestamps to milliseconds since epoch
 
-def parse(l):
-  l = re_color.sub('', l[:-1])
-  if not l.startswith('[I '):
-    return
-  level, date, t, file, msg = l.split(None, 4)
+  Timestamps have no year so it's guessed, and advanced when they wrap
+  around. Conversions are cached per second.'''
+  def __init__(self, year):
+    self.year = year
+    self.cache = {}
+    self.last = None
 
-  if msg == 'done with new message':
-    type = 'done'
-  elif re_ping.match(msg):
-    type = 'ping'
+  def __call__(self, date, t):
+    t, ms = t.split('.')
+    key = date, t
+    try:
+      secs = self.cache[key]
+    except KeyError:
+      if len(self.cache) > 100000:
+        self.cache.clear()
+      dtstr = '%s-%s %s' % (self.year, date, t)
+      secs = int(time.mktime(time.strptime(dtstr, '%Y-%m-%d %H:%M:%S')))
+      if self.last is not None and secs < self.last - 180 * 86400:
+        # a new year
+        self.year += 1
+        self.cache.clear()
+        return self(date, t + '.' + ms)
+      self.cache[key] = secs
+    self.last = secs
+    return secs * 1000 + int(ms)
+
+def classify(msg):
+  if re_ping.match(msg):
+    return 'ping'
   elif re_test.match(msg):
-    type = 'test'
-  elif re_cmd.match(msg):
-    type = 'cmd_' + re_cmd.match(msg).group(1)
+    return 'test'
+  m = re_cmd.match(msg)
+  if m:
+    return 'cmd_' + m.group(1)
   elif re_other_msg.match(msg):
-    type = 'chat'
-  else:
-    return
-
-  t, ms = t.split('.')
-  dtstr = '%s-%s %s' % (year, date, t)
-  t = time.strptime(dtstr, '%Y-%m-%d %H:%M:%S')
-  timestamp = int(time.mktime(t)) * 1000 + int(ms)
-
-  return type, timestamp
-
-def log_entry(fp):
-  for l in fp:
-    r = parse(l)
-    if r:
-      yield r
-
-def stat(file):
-  data = defaultdict(int)
-  count = defaultdict(int)
-  it = log_entry(open(file))
-  tn = None
-  while True:
-    try:
-      if tn is not None:
-        type1, t1 = tn
-        tn = None
-      else:
-        type1, t1 = next(it)
-      type2, t2 = next(it)
-      if type2 != 'done':
-        #ignore it
-        tn = type2, t2
+    return 'chat'
+
+def open_log(file):
+  if file == '-':
+    return sys.stdin
+  if file.endswith('.gz'):
+    return gzip.open(file, 'rt', errors='replace')
+  return open(file, errors='replace')
+
+def percentile(sorted_data, p):
+  return sorted_data[min(len(sorted_data) * p // 100, len(sorted_data) - 1)]
+
+class Stat:
+  def __init__(self, year):
+    self.timestamp = Timestamps(year)
+    # type -> durations in milliseconds
+    self.data = defaultdict(lambda: array('l'))
+    # the message being handled: (type, timestamp)
+    self.pending = None
+    self.unmatched = 0
+    self.first = self.last = None
+
+  def feed(self, fp):
+    timestamp = self.timestamp
+    data = self.data
+    for l in fp:
+      if '\x1b' in l or '\x0f' in l:
+        l = re_color.sub('', l)
+      if not l.startswith('[I '):
         continue
-    except StopIteration:
-      break
+      try:
+        level, date, t, file, msg = l.rstrip('\n').split(None, 4)
+      except ValueError:
+        continue
+
+      if msg == 'done with new message':
+        if self.pending is None:
+          continue
+        type, t1 = self.pending
+        self.pending = None
+        t2 = self.last = timestamp(date, t)
+        data[type].append(t2 - t1)
+      elif file.startswith('main:') and msg.startswith('['):
+        type = classify(msg)
+        if type is None:
+          continue
+        if self.pending is not None:
+          # no "done" for it, e.g. it's ignored on purpose
+          self.unmatched += 1
+        t1 = timestamp(date, t)
+        self.pending = type, t1
+        if self.first is None:
+          self.first = t1
+
+  def report(self, out=sys.stdout):
+    if self.last is None:
+      print('no messages found.', file=out)
+      return
+    minutes = max(self.last - self.first, 1) / 60000
+    print('%-20s %8s %9s %9s %9s %9s %9s %9s' % (
+      'type', 'count', 'mean', 'p50', 'p95', 'p99', 'max', 'per min'), file=out)
+    for type in sorted(self.data):
+      d = sorted(self.data[type])
+      n = len(d)
+      print('%-20s %8d %7dms %7dms %7dms %7dms %7dms %9.2f' % (
+        type, n, sum(d) // n, percentile(d, 50), percentile(d, 95),
+        percentile(d, 99), d[-1], n / minutes), file=out)
+    if self.unmatched:
+      print('(%d messages without a "done" line ignored)' % self.unmatched,
+            file=out)
 
-    data[type1] += t2 - t1
-    count[type1] += 1
+def main():
+  parser = argparse.ArgumentParser(
+    description='show how long it takes to handle each type of message')
+  parser.add_argument('files', nargs='+', metavar='LOGFILE',
+                      help='log files, oldest first; may be gzipped; "-" for stdin')
+  parser.add_argument('--year', type=int, default=time.localtime().tm_year,
+                      help='the year of the first log entry (default: this year)')
+  args = parser.parse_args()
 
-  for k in sorted(data.keys()):
-    print('%s: %dms, %d entries' % (k, data[k] // count[k], count[k]))
+  st = Stat(args.year)
+  for file in args.files:
+    with open_log(file) as fp:
+      st.feed(fp)
+  st.report()
 
 if __name__ == '__main__':
-  if len(sys.argv) != 2:
-    sys.exit('no logfile provided.')
-  stat(sys.argv[1])
+  main()
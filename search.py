@@ -0,0 +1,140 @@
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+import re
+import bisect
+import logging
+import unicodedata
+from collections import defaultdict
+
+'''full-text search over log entries
+
+Text is split into words; runs of CJK characters, which have no spaces in
+between, are indexed as overlapping bigrams. A query matches entries that
+contain all its words; the index narrows down the candidates and each one is
+checked for the words as substrings.
+'''
+
+logger = logging.getLogger(__name__)
+
+re_word = re.compile(r'\w+')
+# Han, kana and Hangul
+re_cjk = re.compile(
+  '([぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+)')
+
+def normalize(text):
+  '''fold width and case, so that e.g. "ＡＢＣ" matches "abc"'''
+  return unicodedata.normalize('NFKC', text).lower()
+
+def tokenize(text, query=False):
+  '''return the index tokens of normalized `text`
+
+  A single CJK character between others is not a token by itself, so it's
+  left out of a query (`query=True`) and left to the substring check.'''
+  tokens = []
+  for word in re_word.findall(text):
+    for i, part in enumerate(re_cjk.split(word)):
+      if not part:
+        continue
+      if i % 2 == 0 or len(part) == 1:
+        if not (query and i % 2):
+          tokens.append(part)
+      else:
+        tokens.extend(part[j:j+2] for j in range(len(part) - 1))
+  return tokens
+
+class SearchIndex:
+  '''an inverted index of the last `size` or more log entries
+
+  Entries get increasing ids as they are added, so the posting lists stay
+  sorted and the most recent matches are found first.'''
+  def __init__(self, size):
+    self.size = size
+    # oldest first; the id of entries[i] is base + i
+    self.entries = []
+    self.base = 0
+    # token -> ids of entries having it, ascending
+    self.postings = defaultdict(list)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def load(self, entries):
+    self.entries = []
+    self.base = 0
+    self.postings.clear()
+    for entry in list(entries)[-self.size:]:
+      self.add(entry)
+    logger.info('%d log entries indexed for search', len(self.entries))
+
+  def add(self, entry):
+    id = self.base + len(self.entries)
+    self.entries.append(entry)
+    postings = self.postings
+    for token in set(tokenize(normalize(entry.msg or ''))):
+      postings[token].append(id)
+    if len(self.entries) > 2 * self.size:
+      self._evict()
+
+  def _evict(self):
+    drop = len(self.entries) - self.size
+    del self.entries[:drop]
+    self.base += drop
+    base = self.base
+    postings = self.postings
+    for token in list(postings):
+      ids = postings[token]
+      i = bisect.bisect_left(ids, base)
+      if i == len(ids):
+        del postings[token]
+      elif i:
+        del ids[:i]
+
+  def search(self, query, limit):
+    '''return at most `limit` entries containing all words of `query`, the
+    most recent first'''
+    query = normalize(query)
+    words = re_word.findall(query)
+    if not words:
+      return []
+    tokens = set(tokenize(query, query=True))
+    base = self.base
+    entries = self.entries
+
+    if tokens:
+      lists = sorted((self.postings.get(t, ()) for t in tokens), key=len)
+      shortest, rest = lists[0], lists[1:]
+      candidates = (id for id in reversed(shortest)
+                    if all(_contains(ids, id) for ids in rest))
+    else:
+      # only single CJK characters; look through everything
+      candidates = range(base + len(entries) - 1, base - 1, -1)
+
+    ret = []
+    for id in candidates:
+      entry = entries[id - base]
+      text = normalize(entry.msg or '')
+      if all(w in text for w in words):
+        ret.append(entry)
+        if len(ret) >= limit:
+          break
+    return ret
+
+def _contains(ids, id):
+  i = bisect.bisect_left(ids, id)
+  return i != len(ids) and ids[i] == id
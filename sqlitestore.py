@@ -0,0 +1,569 @@
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import json
+import sqlite3
+import logging
+import datetime
+import threading
+import contextlib
+
+'''an SQLite backend providing the part of mongokit and pymongo we use
+
+Each database is a file in WAL mode, and each collection a table with a
+column for every field in the document `structure`; other fields of
+schemaless documents are kept as JSON, and can be saved and loaded but not
+queried or updated with operators. Indexes declared by registered documents
+are created when their collection is first used. A capped collection is
+emulated by deleting the oldest rows when there are too many.
+
+Only the query operators `$in`, `$gt`, `$gte`, `$lt`, `$lte` and the update
+operators `$set` and `$inc` are supported.
+'''
+
+logger = logging.getLogger(__name__)
+
+class ValidationError(Exception):
+  pass
+
+class OperationFailure(Exception):
+  pass
+
+class DuplicateKeyError(OperationFailure):
+  pass
+
+class MultipleResultsFound(Exception):
+  pass
+
+_operators = {
+  '$gt': '>',
+  '$gte': '>=',
+  '$lt': '<',
+  '$lte': '<=',
+}
+# with this many values, `$in` is passed as one JSON array parameter
+_in_max_params = 100
+
+def _quote(name):
+  return '"%s"' % name.replace('"', '""')
+
+def _sqltype(type):
+  if type in (int, bool):
+    return 'INTEGER'
+  elif type is float:
+    return 'REAL'
+  else:
+    return 'TEXT'
+
+def _encode(type, value):
+  if value is None:
+    return
+  if type is datetime.datetime:
+    return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+  elif type is bool:
+    return int(value)
+  elif type in (int, float, str):
+    return value
+  else:
+    return json.dumps(value)
+
+def _decode_datetime(s):
+  # strptime is several times slower
+  return datetime.datetime(
+    int(s[0:4]), int(s[5:7]), int(s[8:10]),
+    int(s[11:13]), int(s[14:16]), int(s[17:19]), int(s[20:26]),
+  )
+
+def _identity(value):
+  return value
+
+def _decoder(type):
+  if type is datetime.datetime:
+    return _decode_datetime
+  elif type is bool:
+    return bool
+  elif type in (int, float, str):
+    return _identity
+  else:
+    return json.loads
+
+class Cursor:
+  '''a lazy query, like pymongo's'''
+  def __init__(self, collection, spec, fields, wrap):
+    self.collection = collection
+    self.spec = spec
+    self.fields = fields
+    self.wrap = wrap
+    self._sort = []
+    self._skip = 0
+    self._limit = 0
+
+  def sort(self, key, direction=1):
+    self._sort.append((key, direction))
+    return self
+
+  def skip(self, n):
+    self._skip = n
+    return self
+
+  def limit(self, n):
+    self._limit = n
+    return self
+
+  def __iter__(self):
+    docs = self.collection._select(
+      self.spec, self.fields, self._sort, self._skip, self._limit)
+    return iter([self.wrap(d) for d in docs])
+
+class Collection:
+  def __init__(self, database, name, structure, indexes=()):
+    self.database = database
+    self.name = name
+    self.table = _quote(name)
+    self.structure = structure
+    self.fields = list(structure)
+    self.types = {k: v for k, v in structure.items()}
+    self.types['_id'] = int
+    self.decoders = {k: _decoder(v) for k, v in self.types.items()}
+    self._create()
+    for index in indexes:
+      fields = index['fields']
+      if isinstance(fields, str):
+        fields = [fields]
+      self.ensure_index([f if isinstance(f, tuple) else (f, 1) for f in fields],
+                        unique=index.get('unique', False))
+    row = database.execute(
+      'SELECT max_rows FROM _collections WHERE name = ?', (name,)).fetchone()
+    self.max_rows = row and row[0]
+
+  def _create(self):
+    db = self.database
+    columns = ''.join(', %s %s' % (_quote(k), _sqltype(v))
+                      for k, v in self.structure.items())
+    db.execute('CREATE TABLE IF NOT EXISTS %s '
+               '(_id INTEGER PRIMARY KEY AUTOINCREMENT%s, _extra TEXT)' % (
+                 self.table, columns))
+    # fields added to the structure later
+    existing = {r[1] for r in db.execute('PRAGMA table_info(%s)' % self.table)}
+    for k, v in self.structure.items():
+      if k not in existing:
+        logger.info('adding column %s to %s', k, self.name)
+        db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+          self.table, _quote(k), _sqltype(v)))
+
+  def _column(self, key):
+    if key not in self.types:
+      raise OperationFailure('%s.%s is not in the structure' % (self.name, key))
+    return _quote(key)
+
+  def _where(self, spec):
+    if not spec:
+      return '', []
+    clauses = []
+    params = []
+    for key, cond in spec.items():
+      col = self._column(key)
+      type = self.types[key]
+      if not isinstance(cond, dict):
+        if cond is None:
+          clauses.append('%s IS NULL' % col)
+        else:
+          clauses.append('%s = ?' % col)
+          params.append(_encode(type, cond))
+        continue
+      for op, value in cond.items():
+        if op == '$in':
+          values = [_encode(type, v) for v in value]
+          if len(values) > _in_max_params:
+            clauses.append('%s IN (SELECT value FROM json_each(?))' % col)
+            params.append(json.dumps(values))
+          elif values:
+            clauses.append('%s IN (%s)' % (col, ', '.join('?' * len(values))))
+            params.extend(values)
+          else:
+            clauses.append('0')
+        elif op in _operators:
+          clauses.append('%s %s ?' % (col, _operators[op]))
+          params.append(_encode(type, value))
+        else:
+          raise OperationFailure('unsupported query operator: %s' % op)
+    return ' WHERE ' + ' AND '.join(clauses), params
+
+  def _select(self, spec=None, fields=None, sort=(), skip=0, limit=0):
+    '''return matching documents as `dict`s'''
+    if fields is None:
+      cols = self.fields
+      extra = True
+    else:
+      if isinstance(fields, dict):
+        fields = [k for k, v in fields.items() if v]
+      cols = [f for f in fields if f in self.structure]
+      extra = False
+    sql = 'SELECT _id%s%s FROM %s' % (
+      ''.join(', ' + _quote(c) for c in cols),
+      ', _extra' if extra else '', self.table)
+    where, params = self._where(spec)
+    sql += where
+    if sort:
+      sql += ' ORDER BY ' + ', '.join(
+        '%s %s' % ('_id' if key == '$natural' else self._column(key),
+                   'DESC' if direction < 0 else 'ASC')
+        for key, direction in sort)
+    if limit or skip:
+      sql += ' LIMIT %d OFFSET %d' % (limit or -1, skip)
+
+    decoders = [self.decoders[c] for c in cols]
+    ret = []
+    for row in self.database.execute(sql, params):
+      doc = {'_id': row[0]}
+      for name, decode, value in zip(cols, decoders, row[1:]):
+        doc[name] = None if value is None else decode(value)
+      if extra and row[-1]:
+        doc.update(json.loads(row[-1]))
+      ret.append(doc)
+    return ret
+
+  def _values(self, doc):
+    values = [_encode(self.types[k], doc.get(k)) for k in self.fields]
+    extra = {k: v for k, v in doc.items()
+             if k not in self.types}
+    values.append(json.dumps(extra) if extra else None)
+    return values
+
+  def find(self, spec=None, fields=None):
+    return Cursor(self, spec, fields, _identity)
+
+  def insert(self, docs):
+    '''insert a document or a list of them in one transaction, setting their
+    `_id`s
+
+    Documents that have an `_id` are inserted with it, so that inserting one
+    again raises `DuplicateKeyError` as with MongoDB. The `_id`s are only set
+    once the transaction is committed.'''
+    if isinstance(docs, dict):
+      docs = [docs]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+      self.table,
+      ', '.join(['_id'] + [_quote(k) for k in self.fields] + ['_extra']),
+      ', '.join('?' * (len(self.fields) + 2)))
+    db = self.database
+    ids = []
+    with db.transaction():
+      for doc in docs:
+        # SQLite chooses one for `None`
+        params = [doc.get('_id')] + self._values(doc)
+        ids.append(db.execute(sql, params).lastrowid)
+      if self.max_rows and docs:
+        db.execute('DELETE FROM %s WHERE _id <= ?' % self.table,
+                   (max(ids) - self.max_rows,))
+    for doc, id in zip(docs, ids):
+      doc['_id'] = id
+    return ids
+
+  def save(self, doc):
+    if '_id' not in doc:
+      self.insert(doc)
+      return
+    self.database.execute('UPDATE %s SET %s WHERE _id = ?' % (
+      self.table, ', '.join('%s = ?' % _quote(k) for k in self.fields + ['_extra'])),
+      self._values(doc) + [doc['_id']])
+
+  def update(self, spec, document, upsert=False, multi=False):
+    sets = []
+    params = []
+    for op, fields in document.items():
+      for key, value in fields.items():
+        col = self._column(key)
+        if op == '$set':
+          sets.append('%s = ?' % col)
+          params.append(_encode(self.types[key], value))
+        elif op == '$inc':
+          sets.append('%s = coalesce(%s, 0) + ?' % (col, col))
+          params.append(value)
+        else:
+          raise OperationFailure('unsupported update operator: %s' % op)
+
+    where, wparams = self._where(spec)
+    if not multi:
+      where = ' WHERE _id = (SELECT _id FROM %s%s LIMIT 1)' % (self.table, where)
+    db = self.database
+    with db.transaction():
+      n = db.execute('UPDATE %s SET %s%s' % (self.table, ', '.join(sets), where),
+                     params + wparams).rowcount
+      if n == 0 and upsert:
+        doc = {k: v for k, v in (spec or {}).items() if not isinstance(v, dict)}
+        doc.update(document.get('$set', {}))
+        doc.update(document.get('$inc', {}))
+        self.insert(doc)
+
+  def find_and_modify(self, query=None, update=None, new=False):
+    '''update the first matching document; return it as it was before, or
+    after if `new`, or `None` if nothing matches'''
+    with self.database.transaction():
+      docs = self._select(query, limit=1)
+      if not docs:
+        return
+      spec = {'_id': docs[0]['_id']}
+      self.update(spec, update)
+      if new:
+        docs = self._select(spec)
+    return docs[0]
+
+  def remove(self, spec=None):
+    where, params = self._where(spec)
+    self.database.execute('DELETE FROM %s%s' % (self.table, where), params)
+
+  def ensure_index(self, fields, unique=False, ttl=None):
+    '''`fields` is a list of (name, direction)'''
+    name = _quote('%s_%s' % (self.name, '_'.join(k for k, __ in fields)))
+    self.database.execute('CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)' % (
+      'UNIQUE ' if unique else '', name, self.table,
+      ', '.join('%s %s' % (self._column(k), 'DESC' if d < 0 else 'ASC')
+                for k, d in fields)))
+
+class Database:
+  def __init__(self, connection, name, path):
+    self.connection = connection
+    self.name = name
+    self.lock = threading.RLock()
+    self._depth = 0
+    # the bot is single-threaded, but scripts may run it in another thread
+    self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    self.db.execute('PRAGMA journal_mode = WAL')
+    # no fsync on each commit; the database stays consistent on power loss
+    self.db.execute('PRAGMA synchronous = NORMAL')
+    self.db.execute('CREATE TABLE IF NOT EXISTS _collections '
+                    '(name TEXT PRIMARY KEY, max_rows INTEGER)')
+    self.collections = {}
+
+  def __getitem__(self, name):
+    try:
+      return self.collections[name]
+    except KeyError:
+      structure, indexes = self.connection._schemas.get(name, ({}, ()))
+      col = self.collections[name] = Collection(self, name, structure, indexes)
+      return col
+
+  def execute(self, sql, params=()):
+    with self.lock:
+      try:
+        return self.db.execute(sql, params)
+      except sqlite3.IntegrityError as e:
+        raise DuplicateKeyError(str(e))
+      except sqlite3.Error as e:
+        raise OperationFailure(str(e))
+
+  @contextlib.contextmanager
+  def transaction(self):
+    with self.lock:
+      self._depth += 1
+      if self._depth == 1:
+        self.db.execute('BEGIN')
+      try:
+        yield
+      except:
+        if self._depth == 1:
+          self.db.execute('ROLLBACK')
+        raise
+      else:
+        if self._depth == 1:
+          self.db.execute('COMMIT')
+      finally:
+        self._depth -= 1
+
+  def create_collection(self, name, capped=False, size=None, max=None):
+    '''a capped collection keeps at most `max` rows, or about 6 per KiB of
+    `size`'''
+    if capped:
+      max = max or size * 6 // 1024
+      self.execute('INSERT OR REPLACE INTO _collections VALUES (?, ?)',
+                   (name, max))
+    col = self[name]
+    col.max_rows = max if capped else None
+    return col
+
+  def collection_names(self):
+    return [r[0] for r in self.execute(
+      "SELECT name FROM sqlite_master WHERE type = 'table' "
+      "AND name NOT LIKE '\\_%' ESCAPE '\\' AND name NOT LIKE 'sqlite%'")]
+
+  def command(self, name):
+    if name == 'getLastError':
+      # errors are raised right away
+      return {'err': None}
+    raise OperationFailure('unsupported command: %s' % name)
+
+  def close(self):
+    self.db.close()
+
+class Document(dict):
+  '''a dict with a schema, like mongokit's
+
+  The instances `Connection` returns for registered documents are bound to
+  their collections; call one to get a new document.'''
+  structure = {}
+  default_values = {}
+  required_fields = []
+  validators = {}
+  indexes = []
+  use_schemaless = False
+  use_dot_notation = False
+  # set on the subclasses `Connection` creates
+  collection = None
+
+  def __init__(self, doc=None, gen_default=True):
+    super().__init__()
+    if doc is not None:
+      dict.update(self, doc)
+    elif gen_default:
+      for key, type in self.structure.items():
+        value = self.default_values.get(key)
+        if callable(value):
+          value = value()
+        elif value is None and isinstance(type, list):
+          value = []
+        self[key] = value
+
+  def __call__(self, doc=None, gen_default=True):
+    return self.__class__(doc, gen_default)
+
+  def __getattr__(self, key):
+    if self.use_dot_notation and not key.startswith('__'):
+      try:
+        return self[key]
+      except KeyError:
+        pass
+    raise AttributeError(key)
+
+  def __setattr__(self, key, value):
+    if self.use_dot_notation and (key in self.structure or key in self):
+      self[key] = value
+    else:
+      super().__setattr__(key, value)
+
+  def validate(self):
+    for key in self.required_fields:
+      if self.get(key) is None:
+        raise ValidationError('%s is required' % key)
+    for key, type in self.structure.items():
+      value = self.get(key)
+      if value is None:
+        continue
+      if isinstance(type, list):
+        ok = isinstance(value, list) and all(isinstance(x, type[0]) for x in value)
+      else:
+        ok = isinstance(value, type)
+      if not ok:
+        raise ValidationError('%s must be of %s, not %r' % (key, type, value))
+    for key, validator in self.validators.items():
+      value = self.get(key)
+      if value is None:
+        continue
+      try:
+        ok = validator(value)
+      except ValidationError as e:
+        raise ValidationError(str(e).replace('%s', key, 1))
+      if not ok:
+        raise ValidationError('%s does not pass the validator %s' % (
+          key, validator.__name__))
+
+  def save(self, validate=True):
+    if validate:
+      self.validate()
+    self.collection.save(self)
+
+  def delete(self):
+    self.collection.remove({'_id': self['_id']})
+
+  def reload(self):
+    doc = self.collection._select({'_id': self['_id']})[0]
+    self.clear()
+    dict.update(self, doc)
+
+  def find(self, spec=None, fields=None):
+    return Cursor(self.collection, spec, fields, self.__class__)
+
+  def find_one(self, spec=None, fields=None):
+    for doc in self.find(spec, fields).limit(1):
+      return doc
+
+  def one(self, spec=None, fields=None):
+    docs = list(self.find(spec, fields).limit(2))
+    if len(docs) > 1:
+      raise MultipleResultsFound('%s documents found' % len(docs))
+    return docs[0] if docs else None
+
+class Connection:
+  '''databases are files named `<name>.sqlite3` under `directory`'''
+  def __init__(self, directory='.'):
+    self.directory = directory
+    self._databases = {}
+    # document name -> class
+    self._documents = {}
+    # document name -> the bound instance
+    self._bound = {}
+    # collection name -> (structure, indexes)
+    self._schemas = {}
+
+  def register(self, documents):
+    for cls in documents:
+      self._documents[cls.__name__] = cls
+      self._schemas[cls.__collection__] = cls.structure, cls.indexes
+
+  def __getitem__(self, name):
+    try:
+      return self._databases[name]
+    except KeyError:
+      path = os.path.join(self.directory, name + '.sqlite3')
+      db = self._databases[name] = Database(self, name, path)
+      return db
+
+  def __getattr__(self, name):
+    if name.startswith('_'):
+      raise AttributeError(name)
+    try:
+      return self._bound[name]
+    except KeyError:
+      pass
+    try:
+      cls = self._documents[name]
+    except KeyError:
+      raise AttributeError(name)
+    collection = self[cls.__database__][cls.__collection__]
+    bound = type(name, (cls,), {'collection': collection})(gen_default=False)
+    self._bound[name] = bound
+    return bound
+
+  def drop_database(self, name):
+    db = self._databases.pop(name, None)
+    if db is not None:
+      db.close()
+    self._bound.clear()
+    path = os.path.join(self.directory, name + '.sqlite3')
+    for suffix in ('', '-wal', '-shm'):
+      try:
+        os.remove(path + suffix)
+      except OSError:
+        pass
+
+  def disconnect(self):
+    for db in self._databases.values():
+      db.close()
+    self._databases.clear()
+    self._bound.clear()
@@ -0,0 +1,37 @@
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import sys
+import tempfile
+import importlib.util
+from importlib.machinery import SourceFileLoader
+
+'''run the tests with config.py.example on the SQLite backend'''
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, topdir)
+
+loader = SourceFileLoader('config', os.path.join(topdir, 'config.py.example'))
+config = importlib.util.module_from_spec(
+  importlib.util.spec_from_loader('config', loader))
+loader.exec_module(config)
+sys.modules['config'] = config
+config.storage = 'sqlite'
+config.sqlite_dir = tempfile.mkdtemp(prefix='xmpptalk-test-')
+config.database = 'test'
@@ -0,0 +1,53 @@
+#
+# (C) Copyright 2013 lilydjwg <lilydjwg@gmail.com>
+#
+# This file is part of xmpptalk.
+#
+# xmpptalk is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# xmpptalk is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
+#
+import datetime
+
+import models
+
+models.init()
+
+def make_docs(n):
+  now = datetime.datetime.utcnow()
+  return [{
+    'time': now,
+    'type': 'chat',
+    'jid': 'someone@example.com',
+    'msg': 'message %d' % i,
+  } for i in range(n)]
+
+def logged_messages():
+  return [doc['msg'] for doc in
+          models.connection.Log.collection.find({}, ['msg']).sort('$natural', 1)]
+
+def test_flush_after_partial_insert():
+  collection = models.connection.Log.collection
+  collection.remove({})
+  docs = make_docs(5)
+  # the first two got written before the connection dropped, and pymongo has
+  # given all of them an `_id`
+  collection.insert(docs[:2])
+  next_id = docs[1]['_id'] + 1
+  for i, doc in enumerate(docs[2:]):
+    doc['_id'] = next_id + i
+
+  buffer = models.LogBuffer(10)
+  buffer.pending = docs
+  assert buffer.flush()
+  assert buffer.pending == []
+  assert logged_messages() == ['message %d' % i for i in range(5)]
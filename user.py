@@ -17,35 +17,37 @@
 # along with xmpptalk.  If not, see <http://www.gnu.org/licenses/>.
 #
 import logging
-from functools import lru_cache
 import datetime
 
-import pymongo.errors
-import mongokit
-
 import models
 import config
 from welcome import Welcome
 from misc import *
 
 logger = logging.getLogger(__name__)
+status_batch_size = getattr(config, 'status_batch_size', 50)
+status_batch_interval = getattr(config, 'status_batch_interval', 0.1)
 
 class UserMixin:
-  # _cached_jid: the corresponding jid cached in _cached_user
-  _cached_jid = _cached_user = None
   _cached_gp = None # Group or dict object
+  # increased on each group status change; see `_broadcast_status`
+  _status_generation = 0
   current_jid = current_user = None
 
   @property
   def current_user(self):
-    if self._cached_jid == self.current_jid:
-      return self._cached_user
-
+    '''the `User` document of `self.current_jid`, cached in
+    `self.identity_map`'''
     if self.current_jid is None:
       return
 
     plainjid = str(self.current_jid.bare())
-    user = models.connection.User.one({'jid': plainjid})
+    user = self.identity_map.get(plainjid)
+    if user is not None:
+      return user
+
+    with models.db_latency.time():
+      user = models.connection.User.one({'jid': plainjid})
 
     # not in database
     if user is None:
@@ -54,8 +56,7 @@ class UserMixin:
         return
       Welcome(self.current_jid, self)
 
-    self._cached_jid = self.current_jid
-    self._cached_user = user
+    self.identity_map.put(plainjid, user)
     return user
 
   def handle_userjoin_before(self):
@@ -74,19 +75,33 @@ class UserMixin:
       u.flag = PERM_USER | PERM_GPADMIN | PERM_SYSADMIN
     try:
       u.save()
-    except (pymongo.errors.DuplicateKeyError, mongokit.schema_document.ValidationError):
+    except (models.DuplicateKeyError, models.ValidationError):
       logger.exception('error while creating user: %r', u)
       return False
+    self.receiver_index.add(plainjid, u.stop_until, mute_until=u.mute_until)
+    self.leaderboard.add(plainjid)
     return u
 
+  def user_load_index(self):
+    '''(re)build the in-memory member indexes in one pass, and drop cached
+    user documents and the `online` output, which may be stale as well'''
+    with models.db_latency.time():
+      users = list(models.connection.User.find({}, [
+        'jid', 'stop_until', 'mute_until', 'badpeople', 'nick', 'msg_count',
+        'msg_chars',
+      ]))
+    self.receiver_index.load(users)
+    self.leaderboard.load(users)
+    self.nick_directory.load(users)
+    self.identity_map.clear()
+    self.online_cache = None
+
   def set_user_nick(self, *args, **kwargs):
     '''set sender's nick in database
 
     return the old `User` document, raise ValueError if duplicate
     use `increase` tells if this is an auto action so that the counter should
     not be increased
-
-    This will reset the nick cache.
     '''
     try:
       return self._set_user_nick(*args, **kwargs)['nick']
@@ -97,7 +112,6 @@ class UserMixin:
     '''set sender's nick in database
 
     return the old nick or None
-    This will reset the nick cache.
     '''
     jid = str(self.current_jid.bare())
     user = self._set_user_nick(jid, nick)
@@ -109,8 +123,6 @@ class UserMixin:
     return the old `User` document, raise ValueError if duplicate
     `increase` tells if this is an auto action so that the counter should not
     be increased
-
-    This will reset the nick cache.
     '''
     if getattr(config, "nick_change_interval", None):
       if self.current_user.nick_changes and \
@@ -122,7 +134,7 @@ class UserMixin:
     if self.nick_exists(nick):
       raise ValueError(_('duplicate nick name: %s') % nick)
 
-    self.user_get_nick.cache_clear()
+    self.online_cache = None
     update = {
       '$set': {
         'nick': nick,
@@ -132,61 +144,95 @@ class UserMixin:
     if increase:
       update['$inc'] = {'nick_changes': 1}
 
-    ret = models.connection.User.collection.find_and_modify(
-      {'jid': plainjid}, update
-    )
-    self.current_user.reload()
+    with models.db_latency.time():
+      ret = models.connection.User.collection.find_and_modify(
+        {'jid': plainjid}, update
+      )
+    self.leaderboard.set_nick(plainjid, nick)
+    self.nick_directory.set(plainjid, nick)
+    self.identity_map.invalidate(plainjid)
     return ret
 
-  @lru_cache()
   def user_get_nick(self, plainjid):
     '''get a user's nick
 
-    The result is cached so if any of the users's nicks change, call `cache_clear()`.
     Fallback to `self.get_name` if not found in database'''
-    u = models.connection.User.one({'jid': plainjid}, ['nick'])
-    nick = u.nick if u else None
+    if not self.nick_directory.loaded:
+      self.user_load_index()
+    nick = self.nick_directory.get(plainjid)
     if nick is None:
       #fallback
       nick = self.get_name(plainjid)
     return nick
 
   def nick_exists(self, nick):
-    return models.connection.User.find_one({'nick': nick}, {}) is not None
+    if not self.nick_directory.loaded:
+      self.user_load_index()
+    return nick in self.nick_directory
 
   def get_user_by_nick(self, nick):
-    #TODO to be removed
-    return get_user_by_nick(nick)
+    '''returns a `User` object, or `None` if nobody has the nick'''
+    if not self.nick_directory.loaded:
+      self.user_load_index()
+    jid = self.nick_directory.get_jid(nick)
+    if jid is None:
+      return
+    return self.get_user_by_jid(jid)
 
   def get_user_by_jid(self, jid):
-    return models.connection.User.one({'jid': jid})
+    with models.db_latency.time():
+      return models.connection.User.one({'jid': jid})
 
   def user_reset_stop(self):
-    models.connection.User.collection.update(
-      {'jid': self.current_user.jid}, {'$set': {
-        'stop_until': self.now,
-      }}
-    )
+    with models.db_latency.time():
+      models.connection.User.collection.update(
+        {'jid': self.current_user.jid}, {'$set': {
+          'stop_until': self.now,
+        }}
+      )
+    self.receiver_index.set_stop(self.current_user.jid, None)
+    self.identity_map.invalidate(self.current_user.jid)
     #FIXME: if self.current_user has been deleted
-    self.current_user.reload()
     self.user_update_presence(self.current_user)
 
   def user_reset_mute(self, user):
-    models.connection.User.collection.update(
-      {'jid': user.jid}, {'$set': {
-        'mute_until': self.now,
-      }}
-    )
+    with models.db_latency.time():
+      models.connection.User.collection.update(
+        {'jid': user.jid}, {'$set': {
+          'mute_until': self.now,
+        }}
+      )
+    self.receiver_index.set_mute(user.jid, None)
+    self.identity_map.invalidate(user.jid)
     self.user_update_presence(self.current_user)
 
+  def user_set_mute(self, user, until):
+    '''disallow `user` to speak until `until`; `user` is updated in place'''
+    # user.save() would complain about float instead of int
+    with models.db_latency.time():
+      models.connection.User.collection.update(
+        {'jid': user.jid}, {'$set': {
+          'mute_until': until,
+        }}
+      )
+    user.mute_until = until
+    self.receiver_index.set_mute(user.jid, until)
+    self.identity_map.invalidate(user.jid)
+    self.user_update_presence(user)
+
   def user_update_msglog(self, msg):
-    '''Note: This won't reload `self.current_user`'''
-    models.connection.User.collection.update(
-      {'jid': self.current_user.jid}, {'$inc': {
-        'msg_chars': len(msg),
-        'msg_count': 1,
-      }}
-    )
+    '''Note: `self.current_user` is updated in place, not reloaded'''
+    user = self.current_user
+    with models.db_latency.time():
+      models.connection.User.collection.update(
+        {'jid': user.jid}, {'$inc': {
+          'msg_chars': len(msg),
+          'msg_count': 1,
+        }}
+      )
+    user.msg_chars += len(msg)
+    user.msg_count += 1
+    self.leaderboard.increase(self.current_user.jid, len(msg))
 
   def user_update_presence(self, user):
     if isinstance(user, str):
@@ -194,50 +240,65 @@ class UserMixin:
       if not user:
         return
 
-    prefix = ''
-
-    sec1 = (user.mute_until - self.now).total_seconds()
-    if sec1 > 0:
-      t = (user.mute_until + config.timezoneoffset).strftime(dateformat)
-      prefix += _('(muted until %s) ') % t
+    prefix, seconds = self.presence_prefix(user.mute_until, user.stop_until)
+    # mute or stop changes
+    self.online_cache = None
 
-    sec2 = (user.stop_until - self.now).total_seconds()
-    if sec2 > 0:
-      t = (user.stop_until + config.timezoneoffset).strftime(dateformat)
-      prefix += _('(stopped until %s) ') % t
-
-    try:
-      seconds = min(sec for sec in (sec1, sec2) if sec > 0)
-    except ValueError:
-      seconds = 0
-    logger.debug('%s: %r seconds to go; sec1 = %r, sec2 = %r',
-                 user.jid, seconds, sec1, sec2)
+    logger.debug('%s: %r seconds to go', user.jid, seconds)
     self.xmpp_setstatus(
       prefix + self.group_status,
       to_jid=user.jid,
     )
     if seconds > 0.1:
       self.update_on_setstatus.add(user.jid)
-      # XXX: Too many handlers?
-      self.delayed_call(seconds, self.user_update_presence, user.jid)
+      self.presence_expiry.schedule(
+        user.jid, self.now + datetime.timedelta(seconds=seconds))
     else:
-      try:
-        self.update_on_setstatus.remove(user.jid)
-      except KeyError:
-        pass
+      self.update_on_setstatus.discard(user.jid)
+      self.presence_expiry.cancel(user.jid)
+
+  def presence_prefix(self, mute_until, stop_until, now=None):
+    '''return the status prefix telling about a mute or stop, and the
+    seconds until the first of them ends (0 if none is in effect), as of
+    `now` (default `self.now`)'''
+    if now is None:
+      now = self.now
+    prefix = ''
+    secs = []
+    if mute_until is not None and mute_until > now:
+      t = (mute_until + config.timezoneoffset).strftime(dateformat)
+      prefix += _('(muted until %s) ') % t
+      secs.append((mute_until - now).total_seconds())
+    if stop_until is not None and stop_until > now:
+      t = (stop_until + config.timezoneoffset).strftime(dateformat)
+      prefix += _('(stopped until %s) ') % t
+      secs.append((stop_until - now).total_seconds())
+    return prefix, min(secs) if secs else 0
+
+  def user_presence_expired(self, plainjid):
+    '''called by `self.presence_expiry` when a mute or stop ends'''
+    self.now = datetime.datetime.utcnow()
+    self.user_update_presence(plainjid)
 
   def user_disappeared(self, plainjid):
     if plainjid == self.current_user.jid:
       self.current_user.last_seen == self.now
 
-    models.connection.User.collection.update(
-      {'jid': plainjid}, {'$set': {
-        'last_seen': self.now,
-      }}
-    )
+    with models.db_latency.time():
+      models.connection.User.collection.update(
+        {'jid': plainjid}, {'$set': {
+          'last_seen': self.now,
+        }}
+      )
+    self.identity_map.invalidate(plainjid)
   def user_delete(self, user):
     logger.info('User %s (%s) left', user.nick, user.jid)
     user.delete()
+    self.receiver_index.remove(user.jid)
+    self.leaderboard.remove(user.jid)
+    self.nick_directory.remove(user.jid)
+    self.identity_map.invalidate(user.jid)
+    self.online_cache = None
     self.unsubscribe(user.jid)
     self.unsubscribe(user.jid, type='unsubscribed')
 
@@ -246,7 +307,7 @@ class UserMixin:
     # TODO: 根据 action 区别处理
     plainjid = str(self.current_jid.bare())
 
-    self._cached_jid = None
+    self.identity_map.invalidate(plainjid)
     u = self.db_add_user(plainjid)
     if u is False:
       logger.warning('%s already in database', plainjid)
@@ -257,7 +318,6 @@ class UserMixin:
   def handle_userleave(self, action=None):
     '''user has left, delete the user from database'''
     self.user_delete(self.current_user)
-    self._cached_jid = None
 
   @property
   def group_status(self):
@@ -270,8 +330,37 @@ class UserMixin:
     self._cached_gp = models.connection.Group.collection.find_and_modify(
       None, {'$set': {'status': value}}, new=True
     )
-    for jid in self.update_on_setstatus.copy():
-      self.user_update_presence(jid)
+    self._status_generation += 1
+    self._broadcast_status(
+      self._status_generation, list(self.update_on_setstatus), 0)
+
+  def _broadcast_status(self, generation, jids, start):
+    '''send the new group status to muted or stopped members, whose
+    presences differ, `status_batch_size` at a time from the main loop
+
+    Their mutes and stops are taken from `self.receiver_index`.'''
+    if generation != self._status_generation:
+      # superseded by a newer status
+      return
+    writable = self.stream_writable()
+    if writable is None:
+      return
+    elif writable:
+      # not `self.now`, which belongs to the message being handled
+      now = datetime.datetime.utcnow()
+      status = self.group_status
+      index = self.receiver_index
+      end = start + status_batch_size
+      for jid in jids[start:end]:
+        prefix, seconds = self.presence_prefix(
+          index.muted.get(jid), index.stopped.get(jid), now)
+        self.xmpp_setstatus(prefix + status, to_jid=jid)
+        if not seconds:
+          self.update_on_setstatus.discard(jid)
+      start = end
+    if start < len(jids):
+      self.delayed_call(status_batch_interval, self._broadcast_status,
+                        generation, jids, start)
 
   @property
   def welcome(self):
@@ -284,9 +373,3 @@ class UserMixin:
     self._cached_gp = models.connection.Group.collection.find_and_modify(
       None, {'$set': {'welcome': value}}, new=True
     )
-
-def get_user_by_nick(nick):
-  '''returns a `User` object
-
-  nick should not be `None` or an arbitrary one will be returned'''
-  return models.connection.User.find_one({'nick': nick})